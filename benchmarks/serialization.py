@@ -0,0 +1,53 @@
+"""
+Serialization benchmark
+
+Compares the time to turn N Products into a JSON list body through the
+old path (ORM entity -> Product.serialize() -> marshal(product_model)
+-> json) and through the fast path (row tuple -> rows_to_products()
+-> serializers.dumps()). No database is needed.
+
+    python -m benchmarks.serialization [N ...]
+"""
+import json
+import sys
+import timeit
+from flask_restx import marshal
+from service import app
+from service.models import Product
+from service.routes import product_model
+from service.common import serializers
+
+
+def make_rows(count: int) -> list:
+    """Returns row tuples shaped like the ones Product.columns() selects"""
+    return [(i, f"product {i}", "a fairly ordinary product description " * 4,
+             i % 1000, i % 97, i % 3 > 0) for i in range(1, count + 1)]
+
+
+def old_path(rows):
+    """ORM entities, serialize(), marshal() and the json module"""
+    products = [Product(id=row[0], name=row[1], description=row[2], price=row[3],
+                        like_num=row[4], is_on_shelf=row[5]) for row in rows]
+    return json.dumps(marshal([product.serialize() for product in products], product_model))
+
+
+def new_path(rows):
+    """Row tuples shaped straight into dicts and encoded by the fast serializer"""
+    return serializers.dumps(serializers.rows_to_products(rows))
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1_000, 10_000, 100_000]
+    encoder = "orjson" if serializers.orjson else "json"
+    print(f"{'rows':>8} {'old (ms)':>10} {'new (ms)':>10} {'speedup':>8}   [{encoder}]")
+    with app.app_context():
+        for size in sizes:
+            rows = make_rows(size)
+            runs = max(1, 100_000 // size)
+            old = min(timeit.repeat(lambda: old_path(rows), number=runs, repeat=3)) / runs
+            new = min(timeit.repeat(lambda: new_path(rows), number=runs, repeat=3)) / runs
+            print(f"{size:>8} {old * 1000:>10.1f} {new * 1000:>10.1f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
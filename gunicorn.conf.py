@@ -0,0 +1,29 @@
+"""
+Gunicorn configuration
+
+Prepares the shared directory of the Prometheus multiprocess mode when
+PROMETHEUS_MULTIPROC_DIR is set (see service/common/metrics.py), and
+serves requests with threads: every /api/products/stream client holds
+one for as long as it is connected, which would starve sync workers
+"""
+import glob
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+
+
+def on_starting(server):
+    """Removes the metrics left behind by a previous run"""
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for name in glob.glob(os.path.join(path, "*.db")):
+            os.remove(name)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that exited"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+        multiprocess.mark_process_dead(worker.pid)
@@ -44,7 +44,7 @@ api = Api(app,
           prefix='/api'
           )
 # Import the routes After the Flask app is created
-from service import routes, models
+from service import routes, models, commands
 
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
@@ -54,7 +54,7 @@ app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
 try:
-    routes.init_db()  # make our SQLAlchemy tables
+    routes.init_db()  # connect to the database (run `flask db-upgrade` to create the tables)
 except Exception as error:
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -0,0 +1,58 @@
+"""
+CLI Commands
+
+Flask CLI commands used to operate the service, e.g.
+
+    flask db-upgrade
+    flask products-export --format csv products.csv
+    flask products-import --mode replace products.csv
+"""
+import click
+from service import app, migrations
+from service.common import bulk
+
+
+######################################################################
+# DATABASE MIGRATIONS
+######################################################################
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    """Apply the pending schema migrations"""
+    applied = migrations.upgrade()
+    if applied:
+        click.echo(f"Applied migrations {', '.join(map(str, applied))}")
+    else:
+        click.echo("Database schema is up to date")
+
+
+######################################################################
+# BULK IMPORT AND EXPORT
+######################################################################
+@app.cli.command("products-export")
+@click.argument("output", type=click.File("wb"), default="-")
+@click.option("--format", "fmt", type=click.Choice(bulk.FORMATS), default=None,
+              help="ndjson or csv (guessed from the file name by default)")
+def products_export(output, fmt):
+    """Export every Product to OUTPUT (stdout by default)"""
+    fmt = fmt or guess_format(output.name)
+    for chunk in bulk.export_products(fmt):
+        output.write(chunk)
+
+
+@app.cli.command("products-import")
+@click.argument("source", type=click.File("rb"), default="-")
+@click.option("--format", "fmt", type=click.Choice(bulk.FORMATS), default=None,
+              help="ndjson or csv (guessed from the file name by default)")
+@click.option("--mode", type=click.Choice(bulk.MODES), default="upsert",
+              help="upsert the Products by id, or replace the whole catalog")
+def products_import(source, fmt, mode):
+    """Import Products from SOURCE (stdin by default)"""
+    result = bulk.import_products(source, fmt or guess_format(source.name), mode)
+    for error in result["errors"]:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Imported {result['imported']} products, rejected {result['failed']}")
+
+
+def guess_format(name: str) -> str:
+    """Returns the format of a file from its extension"""
+    return "csv" if str(name).lower().endswith(".csv") else "ndjson"
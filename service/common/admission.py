@@ -0,0 +1,179 @@
+"""
+Admission Control
+
+Load shedding in front of the flask-restx resources, so that a slow
+database degrades the service gracefully instead of piling requests up
+in gunicorn. Every request to a Resource takes a slot in the budget of
+its class (reads, writes, or bulk imports and exports) for as long as it
+is served; when that budget is full the request is turned away at once
+with 503 and a Retry-After header, before it touches the database.
+
+The budgets adapt to the database (AIMD): a budget grows by one slot per
+limit's worth of requests whose queries took less than
+ADMISSION_LATENCY_MS on average, and shrinks by ADMISSION_BACKOFF when
+they took longer, at most once per round of requests in flight. The
+health check reports the worker overloaded while it sheds requests.
+"""
+import threading
+import time
+from flask import current_app, g, jsonify, request
+from service.common import status
+from service.common.metrics import ADMISSION_LIMIT, ADMISSION_REJECTED
+
+# the request classes, each with its own budget
+BUDGETS = ("read", "write", "bulk")
+# methods that only read, whatever the Resource
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class Budget:
+    """The adaptive concurrency limit of one class of requests"""
+
+    def __init__(self, name: str, limit: int, target: float = 0.1, backoff: float = 0.9,
+                 clock=time.monotonic):
+        """
+        :param name: the class of requests
+        :param limit: the most requests served at once, and the starting limit
+        :param target: the mean query latency in seconds above which the limit shrinks
+        :param backoff: the factor applied to the limit when it shrinks
+        """
+        self.name = name
+        self.maximum = limit
+        self.limit = float(limit)
+        self.target = target
+        self.backoff = backoff
+        self.clock = clock
+        self.in_flight = self.admitted = self.rejected = 0
+        self._decreased_at = float("-inf")
+        self._lock = threading.Lock()
+        ADMISSION_LIMIT.labels(name).set(limit)
+
+    def acquire(self):
+        """Takes a slot
+
+        :return: the time the request was admitted, or None when the budget is full
+        """
+        with self._lock:
+            if self.in_flight >= max(1, int(self.limit)):
+                self.rejected += 1
+                return None
+            self.in_flight += 1
+            self.admitted += 1
+            return self.clock()
+
+    def release(self, admitted_at: float, latency: float = None):
+        """Gives a slot back and adapts the limit to the latency the request saw
+
+        :param admitted_at: the time acquire() returned
+        :param latency: the mean latency of the queries of the request in
+                        seconds, None when it sent none
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if latency is None:
+                return
+            if latency > self.target:
+                # the requests admitted before a decrease saw the old limit
+                if admitted_at >= self._decreased_at:
+                    self.limit = max(1.0, self.limit * self.backoff)
+                    self._decreased_at = self.clock()
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            limit = self.limit
+        ADMISSION_LIMIT.labels(self.name).set(limit)
+
+    def stats(self) -> dict:
+        """Returns the current limit and the requests admitted and rejected"""
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "maximum": self.maximum,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+class AdmissionControl:
+    """Admits the requests of the flask-restx resources within their budgets"""
+
+    def __init__(self, bulk=(), reads=(), exempt=(), clock=time.monotonic):
+        """
+        :param bulk: the names of the Resources served from the bulk budget
+        :param reads: the names of the Resources that only read, whatever the method
+        :param exempt: the names of the Resources never limited (long-lived streams)
+        """
+        self.bulk = set(bulk)
+        self.reads = set(reads)
+        self.exempt = set(exempt)
+        self.clock = clock
+        self.enabled = True
+        self.retry_after = 1
+        self.window = 5.0
+        self.budgets = {}
+        self._shed_at = None
+
+    def init_app(self, app):
+        """Reads the ADMISSION_* settings and admits every request of the Flask app"""
+        self.enabled = app.config["ADMISSION_ENABLED"]
+        self.retry_after = app.config["ADMISSION_RETRY_AFTER"]
+        self.window = app.config["ADMISSION_HEALTH_WINDOW"]
+        self.budgets = {
+            name: Budget(name, app.config[f"ADMISSION_{name.upper()}_LIMIT"],
+                         app.config["ADMISSION_LATENCY_MS"] / 1000, app.config["ADMISSION_BACKOFF"],
+                         self.clock)
+            for name in BUDGETS
+        }
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def classify(self):
+        """Returns the budget of the current request, None when it is not limited"""
+        view = current_app.view_functions.get(request.endpoint)
+        view_class = getattr(view, "view_class", None)
+        if view_class is None or view_class.__name__ in self.exempt:
+            return None  # health checks, metrics and the event stream
+        if view_class.__name__ in self.bulk:
+            return "bulk"
+        if request.method in READ_METHODS or view_class.__name__ in self.reads:
+            return "read"
+        return "write"
+
+    def admit(self):
+        """Takes a slot for the request, or turns it away with 503 when its budget is full"""
+        name = self.classify() if self.enabled else None
+        if name is None:
+            return None
+        admitted_at = self.budgets[name].acquire()
+        if admitted_at is None:
+            self._shed_at = self.clock()
+            ADMISSION_REJECTED.labels(name).inc()
+            current_app.logger.warning("Shedding %s %s: the %s budget is full",
+                                       request.method, request.path, name)
+            response = jsonify(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                               error="Service Unavailable",
+                               message=f"Too many {name} requests in progress, retry later")
+            response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            response.headers["Retry-After"] = str(self.retry_after)
+            return response
+        g.admission = (self.budgets[name], admitted_at)
+        return None
+
+    @staticmethod
+    def release(error=None):  # pylint: disable=unused-argument
+        """Gives the slot of the request back with the query latency it saw"""
+        admission = g.pop("admission", None)
+        if admission is None:
+            return
+        budget, admitted_at = admission
+        queries = g.get("db_queries")
+        latency = g.db_seconds / queries if queries else None
+        budget.release(admitted_at, latency)
+
+    def overloaded(self) -> bool:
+        """Tells whether a request was shed in the last ADMISSION_HEALTH_WINDOW seconds"""
+        return self._shed_at is not None and self.clock() - self._shed_at < self.window
+
+    def stats(self) -> dict:
+        """Returns the state of every budget"""
+        return {name: budget.stats() for name, budget in self.budgets.items()}
@@ -0,0 +1,362 @@
+"""
+Bulk import and export
+
+Streams whole catalogs in and out of the product table as NDJSON or CSV
+through PostgreSQL COPY, with constant memory on both sides:
+
+* export runs COPY ... TO STDOUT in a background thread that hands the
+  output over in chunks through a bounded queue, so rows are sent to the
+  client as PostgreSQL produces them
+* import validates every item like Product.deserialize, feeds the valid
+  ones to COPY ... FROM STDIN into a temporary table as they are read,
+  and merges that table into product in the same transaction
+
+Import modes: "upsert" inserts the items without an id and inserts or
+updates the items with one; "replace" swaps the whole catalog for the
+imported items, and is rolled back if any item is invalid.
+"""
+import csv
+import io
+import logging
+import queue
+import threading
+from service.common import constant, serializers
+from service.models import Product, DataValidationError, db
+
+logger = logging.getLogger("flask.app")
+
+FORMATS = ("ndjson", "csv")
+MODES = ("upsert", "replace")
+COLUMNS = ("id", "name", "description", "price", "like_num", "is_on_shelf")
+
+# Size of the chunks handed from COPY to the client and number of chunks buffered
+CHUNK_SIZE = 64 * 1024
+QUEUE_SIZE = 8
+# Most rejected items listed in the result of an import
+ERRORS_MAX = 100
+
+EXPORT_SQL = {
+    "csv": """
+        COPY (SELECT id, name, description, price, like_num, is_on_shelf
+              FROM product ORDER BY id)
+        TO STDOUT WITH (FORMAT csv, HEADER true)
+    """,
+    # one JSON document per line; with control characters as quote and
+    # delimiter (JSON escapes them) COPY writes the documents verbatim
+    "ndjson": """
+        COPY (SELECT row_to_json(p) FROM (
+                  SELECT id::text AS id, name, description, price, like_num, is_on_shelf
+                  FROM product ORDER BY id) AS p)
+        TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')
+    """,
+}
+
+IMPORT_TABLE_SQL = """
+    CREATE TEMPORARY TABLE product_import (
+        line BIGINT NOT NULL,
+        id INTEGER,
+        name VARCHAR NOT NULL,
+        description VARCHAR NOT NULL,
+        price INTEGER NOT NULL,
+        like_num INTEGER,
+        is_on_shelf BOOLEAN
+    ) ON COMMIT DROP
+"""
+IMPORT_COPY_SQL = """
+    COPY product_import (line, id, name, description, price, like_num, is_on_shelf)
+    FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (description))
+"""
+# the last item of each id wins; items without an id get the next id of the sequence
+IMPORT_MERGE_SQL = """
+    INSERT INTO product (id, name, description, price, like_num, is_on_shelf)
+    SELECT coalesce(id, nextval(pg_get_serial_sequence('product', 'id'))),
+           name, description, price, like_num, is_on_shelf
+    FROM (SELECT DISTINCT ON (coalesce(id, -line)) *
+          FROM product_import ORDER BY coalesce(id, -line), line DESC) AS latest
+    ORDER BY line
+    ON CONFLICT (id) DO UPDATE SET
+        name = excluded.name, description = excluded.description, price = excluded.price,
+        like_num = excluded.like_num, is_on_shelf = excluded.is_on_shelf
+"""
+# moves the sequence past the imported ids before new ids are drawn from it
+IMPORT_SEQUENCE_SQL = """
+    SELECT setval(pg_get_serial_sequence('product', 'id'), max_id)
+    FROM (SELECT max(id) AS max_id FROM product_import) AS imported
+    WHERE max_id >= nextval(pg_get_serial_sequence('product', 'id'))
+"""
+
+
+class CopyCancelled(Exception):
+    """Raised in the COPY thread when the client went away"""
+
+
+######################################################################
+#  E X P O R T
+######################################################################
+def export_products(fmt: str = "ndjson"):
+    """Yields the whole catalog as chunks of NDJSON or CSV bytes
+
+    Run it inside an app context (stream_with_context in a view)
+
+    :param fmt: "ndjson" or "csv"
+    :type fmt: str
+    """
+    chunks = queue.Queue(QUEUE_SIZE)
+    cancelled = threading.Event()
+    connection = db.engine.raw_connection()
+    thread = threading.Thread(target=_copy_out, args=(connection, EXPORT_SQL[fmt], chunks, cancelled),
+                              name="product-export", daemon=True)
+    thread.start()
+    finished = False
+    try:
+        while True:
+            item = chunks.get()
+            if item is _DONE:
+                finished = True
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        thread.join()
+        if finished:
+            connection.rollback()
+        else:
+            # the connection may be in the middle of a COPY
+            connection.invalidate()
+        connection.close()
+
+
+# marks the end of the export in the queue of chunks
+_DONE = object()
+
+
+def _copy_out(connection, sql: str, chunks: queue.Queue, cancelled: threading.Event):
+    """Runs COPY TO in the export thread and queues its output in chunks, then _DONE or the error"""
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise CopyCancelled()
+
+    try:
+        writer = _ChunkWriter(put)
+        cursor = connection.cursor()
+        cursor.copy_expert(sql, writer)
+        cursor.close()
+        writer.flush()
+        put(_DONE)
+    except CopyCancelled:
+        pass
+    except Exception as error:  # pylint: disable=broad-except
+        try:
+            put(error)
+        except CopyCancelled:
+            pass
+
+
+class _ChunkWriter:
+    """File-like target of COPY TO that hands the output over in chunks"""
+
+    def __init__(self, put):
+        self.put = put
+        self.buffer = bytearray()
+
+    def write(self, data):
+        """Buffers a row written by COPY"""
+        self.buffer += data.encode("utf-8") if isinstance(data, str) else data
+        if len(self.buffer) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Hands the buffered rows over"""
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+######################################################################
+#  I M P O R T
+######################################################################
+def import_products(source, fmt: str = "ndjson", mode: str = "upsert") -> dict:
+    """Imports Products from a binary stream of NDJSON or CSV in one transaction
+
+    :param source: the binary file-like object to read the items from
+    :param fmt: "ndjson" or "csv"
+    :type fmt: str
+    :param mode: "upsert" or "replace"
+    :type mode: str
+    :return: the number of Products imported and failed, and the first errors
+    :rtype: dict
+    :raises DataValidationError: when an item is invalid in replace mode
+    """
+    result = {"imported": 0, "failed": 0, "errors": []}
+    items = read_ndjson(source) if fmt == "ndjson" else read_csv(source)
+    reader = _ChunkReader(_copy_rows(items, result))
+    try:
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute(IMPORT_TABLE_SQL)
+        cursor.copy_expert(IMPORT_COPY_SQL, reader, size=CHUNK_SIZE)
+        if mode == "replace":
+            if result["failed"]:
+                raise DataValidationError(
+                    "Invalid import: {} items were rejected, the catalog was not replaced; first error: {}"
+                    .format(result["failed"], result["errors"][0]["error"]))
+            cursor.execute("DELETE FROM product")
+        cursor.execute(IMPORT_SEQUENCE_SQL)
+        cursor.execute(IMPORT_MERGE_SQL)
+        result["imported"] = cursor.rowcount
+        cursor.close()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    Product.cache.clear()
+    logger.info("Imported %d products (%s), rejected %d", result["imported"], mode, result["failed"])
+    return result
+
+
+def read_ndjson(source):
+    """Yields the line number and the decoded item of every NDJSON line"""
+    for number, line in enumerate(source, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, serializers.loads(line)
+        except ValueError:
+            yield number, line  # reported as invalid by validate()
+
+
+def read_csv(source):
+    """Yields the line number and the typed item of every CSV row"""
+    lines = io.TextIOWrapper(source, encoding="utf-8", newline="")
+    reader = csv.DictReader(lines)
+    for row in reader:
+        item = {key: value for key, value in row.items() if key in COLUMNS and value != ""}
+        for key in ("id", "price", "like_num"):
+            if key in item:
+                item[key] = _number(item[key])
+        if "is_on_shelf" in item:
+            item["is_on_shelf"] = _boolean(item["is_on_shelf"])
+        # empty columns are left out, so they get the defaults of Product.deserialize
+        yield reader.line_num, item
+
+
+def validate(item) -> tuple:
+    """Validates an item like Product.deserialize and returns its column values
+
+    :raises DataValidationError: when the item is not a valid Product
+    """
+    if not isinstance(item, dict):
+        raise DataValidationError("Invalid product: body of request contained bad or no data.")
+    item = dict(item)
+    if item.get("description") is None:
+        item.pop("description", None)
+    # the validation of Product.deserialize without the cost of an ORM instance
+    product = Product.deserialize(_Fields(), item)
+    product_id = item.get("id")
+    if product_id is not None:
+        # exported (and product_model) ids are strings
+        if isinstance(product_id, str) and product_id.strip().isdigit():
+            product_id = int(product_id)
+        product_id = _integer(product_id, "id")
+        if product_id <= 0:
+            raise DataValidationError("Invalid product: id must be positive")
+    return (product_id,) + check_columns(product)
+
+
+def check_columns(product) -> tuple:
+    """Checks that the fields of a deserialized Product fit their columns
+
+    :return: the name, description, price, like_num and is_on_shelf to write
+    :raises DataValidationError: when a field does not fit its column
+    """
+    price = _integer(product.price, "price")
+    like_num = None if product.like_num is None else _integer(product.like_num, "like_num")
+    if product.is_on_shelf is not None and not isinstance(product.is_on_shelf, bool):
+        raise DataValidationError("Invalid product: is_on_shelf must be a boolean")
+    return product.name, product.description, price, like_num, product.is_on_shelf
+
+
+class _Fields:  # pylint: disable=too-few-public-methods
+    """Plain holder of the fields set by Product.deserialize"""
+    __slots__ = ("name", "description", "price", "like_num", "is_on_shelf")
+
+
+def _copy_rows(items, result):
+    """Yields the valid items as CSV rows for COPY and records the invalid ones"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for number, item in items:
+        try:
+            row = validate(item)
+        except DataValidationError as error:
+            result["failed"] += 1
+            if len(result["errors"]) < ERRORS_MAX:
+                result["errors"].append({"line": number, "error": str(error)})
+            continue
+        writer.writerow((number,) + row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkReader:
+    """File-like source of COPY FROM that reads from an iterator of chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read(self, size=-1):
+        """Returns at most size bytes, or b"" at the end"""
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _number(value: str):
+    """Converts a CSV number, leaving invalid values to the validation"""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def _boolean(value: str):
+    """Converts a CSV boolean (true/false, t/f, 1/0, yes/no)"""
+    lowered = value.strip().lower()
+    if lowered in ("true", "t", "1", "yes", "y"):
+        return True
+    if lowered in ("false", "f", "0", "no", "n"):
+        return False
+    return value
+
+
+def _integer(value, name: str) -> int:
+    """Checks that a number is an integer that fits an INTEGER column"""
+    try:
+        if isinstance(value, bool) or int(value) != value:
+            raise ValueError(value)
+    except (TypeError, ValueError, OverflowError) as error:
+        raise DataValidationError(f"Invalid product: {name} must be an integer") from error
+    if not constant.INTEGER_MIN <= value <= constant.INTEGER_MAX:
+        raise DataValidationError(f"Invalid product: {name} is out of range")
+    return int(value)
@@ -0,0 +1,197 @@
+"""
+Cache
+
+Read-through cache backends for serialized Products. LocalCache keeps
+the entries of one worker in memory with LRU eviction and a TTL, while
+RedisCache shares them between workers. Both keep hit, miss and
+eviction counters so the cache can be watched in production.
+
+A value read from the database may be stale by the time it is cached: a
+write can commit and delete the key in between. Readers take the
+generation() of the key before they read and pass it to set(), which
+drops the value when the key was deleted (or the cache cleared) since.
+RedisCache degrades to a miss when Redis fails, so reads fall through
+to the database.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+
+class LocalCache:
+    """In-process LRU cache whose entries expire after a TTL"""
+
+    def __init__(self, max_entries: int = 4096, ttl: float = 30.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        # bumped by delete() per key, and by clear() for every key
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Returns the value cached under key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, key: str):
+        """Returns the generation of key, to pass to set() with the value read after it"""
+        with self._lock:
+            return self._epoch, self._generations.get(key, 0)
+
+    def set(self, key: str, value, generation=None):
+        """Caches a value under key, evicting the least recently used entry when full
+
+        :param generation: the generation() of key before the value was read;
+                           the value is dropped when key was deleted since
+        """
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(key, 0)):
+                return
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        """Removes the value cached under key"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            if len(self._generations) > self.max_entries:
+                # a new epoch outdates the generations that are forgotten
+                self._generations.clear()
+                self._epoch += 1
+
+    def clear(self):
+        """Removes every cached value"""
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self._epoch += 1
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache"""
+        return {
+            "backend": "local",
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class RedisCache:
+    """Cache shared between workers through Redis
+
+    Evictions are left to the maxmemory policy of the Redis server. Every
+    value is stored with the generation it was read at; delete() gives the
+    key a new random generation, kept without expiry (one small key per
+    deleted Product), and get() ignores values of an older generation.
+    """
+
+    def __init__(self, url: str = None, ttl: float = 30.0, prefix: str = "products:", client=None):
+        if client is None:
+            import redis  # pylint: disable=import-outside-toplevel
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = self.misses = self.errors = 0
+
+    def _generation_key(self, key: str) -> str:
+        return self.prefix + "generation:" + key
+
+    def _failed(self, command: str, error: Exception):
+        self.errors += 1
+        logger.warning("Cache %s failed, falling back to the database: %s", command, error)
+
+    def get(self, key: str):
+        """Returns the value cached under key, or None (also when Redis fails)"""
+        try:
+            value, generation = self.client.mget(self.prefix + key, self._generation_key(key))
+            if value is not None:
+                written, value = json.loads(value)
+                if written is None or written == (generation or b"").decode("utf-8"):
+                    self.hits += 1
+                    return value
+        except Exception as error:  # pylint: disable=broad-except
+            self._failed("get", error)
+            return None
+        self.misses += 1
+        return None
+
+    def generation(self, key: str) -> str:
+        """Returns the generation of key, to pass to set() with the value read after it"""
+        try:
+            return (self.client.get(self._generation_key(key)) or b"").decode("utf-8")
+        except Exception as error:  # pylint: disable=broad-except
+            self._failed("generation", error)
+            return uuid.uuid4().hex  # matches no generation: the value will not be served
+
+    def set(self, key: str, value, generation: str = None):
+        """Caches a value under key until the TTL expires
+
+        :param generation: the generation() of key before the value was read;
+                           the value is ignored when key was deleted since
+        """
+        try:
+            self.client.set(self.prefix + key, json.dumps([generation, value]), px=int(self.ttl * 1000))
+        except Exception as error:  # pylint: disable=broad-except
+            self._failed("set", error)
+
+    def delete(self, key: str):
+        """Removes the value cached under key"""
+        try:
+            self.client.set(self._generation_key(key), uuid.uuid4().hex)
+            self.client.delete(self.prefix + key)
+        except Exception as error:  # pylint: disable=broad-except
+            self._failed("delete", error)
+
+    def clear(self):
+        """Removes every cached value"""
+        try:
+            keys = list(self.client.scan_iter(match=self.prefix + "*"))
+            if keys:
+                self.client.delete(*keys)
+        except Exception as error:  # pylint: disable=broad-except
+            self._failed("clear", error)
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache"""
+        return {
+            "backend": "redis",
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": 0,
+            "errors": self.errors,
+        }
+
+
+def from_config(config, ttl: float = None, prefix: str = "products:"):
+    """Creates the cache backend selected by the CACHE_* settings
+
+    :param ttl: the lifetime of the entries (CACHE_TTL by default)
+    :param prefix: the namespace of the keys in Redis
+    """
+    ttl = config["CACHE_TTL"] if ttl is None else ttl
+    if config["CACHE_URL"]:
+        return RedisCache(config["CACHE_URL"], ttl=ttl, prefix=prefix)
+    return LocalCache(config["CACHE_MAX_ENTRIES"], ttl=ttl)
@@ -4,3 +4,14 @@ Global Constants
 
 LENGTH_MAX_PRODUCT_NAME = 256
 LENGTH_MAX_PRODUCT_DESC = 1024
+
+# PostgreSQL text search configuration of the full-text indexes
+SEARCH_CONFIG = "english"
+
+# Range of the PostgreSQL INTEGER columns (ids, prices, likes)
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+# Range of the PostgreSQL BIGINT columns (change feed transaction ids and sequence)
+BIGINT_MIN = -2 ** 63
+BIGINT_MAX = 2 ** 63 - 1
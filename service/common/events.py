@@ -0,0 +1,234 @@
+"""
+Product Events
+
+Live Product changes for Server-Sent Events clients. The writes of the
+Product model publish every change with PostgreSQL NOTIFY in their own
+transaction, so the event reaches the workers of every instance of the
+service when (and only if) the change commits. In each worker a single listener thread
+holds one LISTEN connection and fans the events out to the queues of the
+clients connected to that worker, keeping only the events of the
+Products each client asked for.
+
+Code that keeps state derived from the Products (the leaderboard of the
+most liked Products) can also register a listener for every event.
+
+A client whose queue fills up (it does not read fast enough) is
+disconnected with a "resync" event so it can catch up through the change
+feed instead of holding events in memory.
+"""
+import logging
+import queue
+import select
+import threading
+import time
+from sqlalchemy import func
+from service.common import serializers
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+# NOTIFY payloads are limited to 8000 bytes
+PAYLOAD_MAX = 8000
+RESYNC = b"event: resync\ndata: {}\n\n"
+
+
+class Subscription:
+    """The queue of events of one connected client"""
+
+    def __init__(self, product_ids=None, size: int = 100):
+        self.product_ids = set(product_ids) if product_ids else None
+        self.events = queue.Queue(size)
+
+    def wants(self, product_id: int) -> bool:
+        """Tells whether the client follows a Product"""
+        return self.product_ids is None or product_id in self.product_ids
+
+    def get(self, timeout: float):
+        """Returns the next event, or None after timeout seconds without one"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def resync(self):
+        """Replaces the pending events with a resync event that ends the stream
+
+        Only the listener thread puts events, so the queue has room once drained
+        """
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                break
+        self.events.put_nowait(RESYNC)
+
+
+class ProductEvents:
+    """Publishes Product changes and fans them out to the subscribed clients"""
+
+    def __init__(self):
+        self.app = None
+        self.channel = "product_events"
+        self.queue_size = 100
+        self.keepalive = 15.0
+        self._subscriptions = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        """Reads the EVENTS_* settings from the Flask app configuration"""
+        self.app = app
+        self.channel = app.config["EVENTS_CHANNEL"]
+        self.queue_size = app.config["EVENTS_QUEUE_SIZE"]
+        self.keepalive = app.config["EVENTS_KEEPALIVE"]
+
+    ######################################################################
+    #  P U B L I S H
+    ######################################################################
+    def publish(self, product: dict, deleted: bool = False):
+        """Notifies every listening worker of a change to a Product
+
+        The NOTIFY is sent in the current transaction of the session, before
+        the write commits: PostgreSQL delivers it with the commit, in commit
+        order, and drops it if the write rolls back
+
+        :param product: the serialized Product (only its id when deleted)
+        :type product: dict
+        :param deleted: whether the Product was deleted
+        :type deleted: bool
+        """
+        event = serializers.shape_product(product)
+        event["deleted"] = deleted
+        payload = serializers.dumps(event).decode("utf-8")
+        if len(payload.encode("utf-8")) > PAYLOAD_MAX:
+            event = {"id": event["id"], "deleted": deleted}
+            payload = serializers.dumps(event).decode("utf-8")
+        db.session.execute(func.pg_notify(self.channel, payload).select())
+
+    ######################################################################
+    #  S U B S C R I B E
+    ######################################################################
+    def subscribe(self, product_ids=None) -> Subscription:
+        """Registers a client, starting the listener of the worker if needed
+
+        :param product_ids: the ids of the Products to follow (all by default)
+        :type product_ids: list
+        """
+        subscription = Subscription(product_ids, self.queue_size)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        self.start()
+        # events published before LISTEN took effect would be missed
+        self._ready.wait(5)
+        return subscription
+
+    def add_listener(self, callback):
+        """Calls callback(event) with every decoded event of every worker
+
+        The callback is called with None when events may have been lost
+        """
+        self._listeners.append(callback)
+
+    def start(self):
+        """Starts the listener thread of the worker unless it is running"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="product-events", daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, subscription: Subscription):
+        """Forgets a client"""
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def subscribers(self) -> int:
+        """Returns the number of connected clients"""
+        return len(self._subscriptions)
+
+    def stream(self, subscription: Subscription):
+        """Yields the Server-Sent Events of a client, with keep-alive comments"""
+        yield b"retry: 3000\n\n"
+        while True:
+            event = subscription.get(self.keepalive)
+            if event is None:
+                yield b": keep-alive\n\n"
+                continue
+            yield event
+            if event is RESYNC:
+                return
+
+    def dispatch(self, payload: str):
+        """Fans an event out to the clients that follow its Product"""
+        try:
+            event = serializers.loads(payload)
+            product_id = int(event["id"])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring malformed product event: %.200s", payload)
+            return
+        self._notify(event)
+        message = b"event: product\ndata: " + payload.encode("utf-8") + b"\n\n"
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if not subscription.wants(product_id):
+                continue
+            try:
+                subscription.events.put_nowait(message)
+            except queue.Full:
+                logger.warning("Disconnecting a slow event stream client")
+                self.unsubscribe(subscription)
+                subscription.resync()
+
+    def _notify(self, event):
+        """Hands an event to the registered listeners"""
+        for callback in self._listeners:
+            try:
+                callback(event)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Product event listener %s failed", callback)
+
+    ######################################################################
+    #  L I S T E N
+    ######################################################################
+    def _run(self):
+        """Listens for events forever, reconnecting after failures"""
+        delay = 0.5
+        while True:
+            try:
+                self._listen()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Product event listener failed, reconnecting")
+            self._ready.clear()
+            # the events published while disconnected are lost: tell the clients
+            self._notify(None)
+            with self._lock:
+                subscriptions = list(self._subscriptions)
+            for subscription in subscriptions:
+                self.unsubscribe(subscription)
+                subscription.resync()
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _listen(self):
+        """Holds a LISTEN connection outside of the pool and dispatches its notifications"""
+        connection = db.get_engine(self.app).raw_connection()
+        connection.detach()
+        try:
+            dbapi = connection.connection
+            dbapi.autocommit = True
+            with dbapi.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self.channel}"')
+            self._ready.set()
+            logger.info("Listening for product events on %s", self.channel)
+            while True:
+                if select.select([dbapi], [], [], self.keepalive) == ([], [], []):
+                    with dbapi.cursor() as cursor:
+                        cursor.execute("SELECT 1")  # detect dead connections
+                    continue
+                dbapi.poll()
+                while dbapi.notifies:
+                    self.dispatch(dbapi.notifies.pop(0).payload)
+        finally:
+            connection.close()
@@ -0,0 +1,119 @@
+"""
+Leaderboard
+
+In-memory top-K of the most liked Products on shelf, so that "most liked"
+is answered without touching the database. The board is seeded from an
+indexed query and then kept up to date with the Products written by the
+like, unlike, shelf and delete paths of every worker (see events.py).
+
+It tracks the Products ranked above a floor: every Product it does not
+track ranks at or below the floor, so the Products it tracks are the
+exact top of the table. A tracked Product that drops to the floor is
+forgotten, an untracked one that rises above it is added. When too few
+Products are left above the floor, when events may have been lost, and
+every TOP_REFRESH seconds anyway, the board is seeded again.
+"""
+import threading
+import time
+from service.common.serializers import PRODUCT_FIELDS
+
+# ranks below every Product: the whole table is tracked
+BOTTOM = (float("-inf"), float("-inf"))
+
+
+def rank(product: dict) -> tuple:
+    """Returns the sort key of a Product: most likes first, ties by lowest id"""
+    like_num = product.get("like_num")
+    return (float("-inf") if like_num is None else like_num, -int(product["id"]))
+
+
+class Leaderboard:
+    """Incrementally maintained top-K of the Products on shelf by like_num"""
+
+    def __init__(self, seed, size: int = 200, refresh: float = 60.0, clock=time.monotonic):
+        """
+        :param seed: returns the given number of Products on shelf, most liked first
+        :param size: the number of Products read by a seed
+        :param refresh: the most seconds between two seeds
+        """
+        self.seed = seed
+        self.size = size
+        self.refresh = refresh
+        self.clock = clock
+        self.seeds = 0
+        self._members = {}
+        self._floor = BOTTOM
+        self._ranking = None
+        self._seeded_at = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Reads the TOP_* settings from the Flask app configuration"""
+        self.size = 2 * app.config["TOP_MAX_N"]
+        self.refresh = app.config["TOP_REFRESH"]
+
+    def top(self, n: int) -> list:
+        """Returns the n most liked Products on shelf
+
+        :param n: the number of Products to return
+        :type n: int
+        :return: the Products, most liked first (ties by lowest id)
+        :rtype: list
+        """
+        with self._lock:
+            if (self._seeded_at is None or self.clock() - self._seeded_at >= self.refresh
+                    or (len(self._members) < n and self._floor != BOTTOM)):
+                self._reseed()
+            if self._ranking is None:
+                self._ranking = sorted(self._members.values(), key=rank, reverse=True)
+            return self._ranking[:n]
+
+    def apply(self, product: dict):
+        """Takes a written Product into account
+
+        :param product: the Product as serialized (or published) after the
+                        write, with "deleted" set when it was deleted; None
+                        when writes may have been missed
+        :type product: dict
+        """
+        with self._lock:
+            if self._seeded_at is None:
+                return
+            if product is None or not product.get("deleted") and (
+                    "like_num" not in product or "is_on_shelf" not in product):
+                self._seeded_at = None  # seed again before the next answer
+                return
+            product_id = int(product["id"])
+            if product.get("deleted") or product["is_on_shelf"] is not True:
+                if self._members.pop(product_id, None) is not None:
+                    self._ranking = None
+                return
+            if rank(product) > self._floor:
+                self._members[product_id] = {field: product.get(field) for field in PRODUCT_FIELDS}
+                self._ranking = None
+                if len(self._members) > 2 * self.size:
+                    self._trim()
+            elif self._members.pop(product_id, None) is not None:
+                self._ranking = None
+
+    def clear(self):
+        """Forgets every Product, the board is seeded again when next read"""
+        with self._lock:
+            self._seeded_at = None
+
+    def _reseed(self):
+        """Reads the top of the table again"""
+        products = self.seed(self.size)
+        self._members = {int(product["id"]): product for product in products}
+        self._floor = rank(products[-1]) if len(products) == self.size else BOTTOM
+        self._ranking = None
+        self._seeded_at = self.clock()
+        self.seeds += 1
+
+    def _trim(self):
+        """Forgets the lowest Products, raising the floor to the highest of them"""
+        ranking = sorted(self._members.values(), key=rank, reverse=True)
+        for product in ranking[self.size:]:
+            del self._members[int(product["id"])]
+        self._floor = rank(ranking[self.size])
+        self._ranking = ranking[:self.size]
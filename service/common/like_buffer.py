@@ -0,0 +1,94 @@
+"""
+Like Buffer
+
+Write-behind aggregation of like/unlike actions. Deltas are summed per
+Product in memory and a background thread applies them to the database
+in one batched UPDATE every LIKE_BUFFER_FLUSH_MS milliseconds, or as soon
+as LIKE_BUFFER_MAX_EVENTS actions are waiting, so a burst of likes on a
+hot Product turns into a single row update instead of a lock convoy.
+
+At most one flush interval (or LIKE_BUFFER_MAX_EVENTS actions) of likes
+can be lost if the worker dies; pending deltas are flushed on shutdown.
+"""
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class LikeBuffer:
+    """Collects like deltas per Product and flushes them in batches"""
+
+    def __init__(self, apply):
+        """
+        :param apply: callable that writes a {product_id: delta} dict
+                      to the database in one statement
+        """
+        self.apply = apply
+        self.app = None
+        self.enabled = False
+        self.flush_interval = 0.2
+        self.max_events = 1000
+        self._deltas = {}
+        self._events = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        """Reads the buffer settings from the Flask app configuration"""
+        self.app = app
+        self.enabled = app.config["LIKE_BUFFER_ENABLED"]
+        self.flush_interval = app.config["LIKE_BUFFER_FLUSH_MS"] / 1000
+        self.max_events = app.config["LIKE_BUFFER_MAX_EVENTS"]
+
+    def add(self, product_id: int, delta: int) -> int:
+        """Records a like delta and returns the delta still pending for the Product"""
+        with self._lock:
+            pending = self._deltas.get(product_id, 0) + delta
+            self._deltas[product_id] = pending
+            self._events += 1
+            if self._events >= self.max_events:
+                self._wakeup.set()
+            if self._thread is None:
+                self._start()
+        return pending
+
+    def pending(self, product_id: int) -> int:
+        """Returns the delta not yet written for a Product"""
+        with self._lock:
+            return self._deltas.get(product_id, 0)
+
+    def flush(self):
+        """Writes every pending delta to the database in one batch"""
+        with self._lock:
+            deltas = {key: value for key, value in self._deltas.items() if value}
+            self._deltas = {}
+            self._events = 0
+        if not deltas:
+            return
+        logger.info("Flushing likes for %d products", len(deltas))
+        try:
+            if self.app:
+                with self.app.app_context():
+                    self.apply(deltas)
+            else:
+                self.apply(deltas)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not flush likes, will retry")
+            with self._lock:
+                for product_id, delta in deltas.items():
+                    self._deltas[product_id] = self._deltas.get(product_id, 0) + delta
+
+    def _start(self):
+        """Starts the background flusher (called with the lock held)"""
+        self._thread = threading.Thread(target=self._run, name="like-buffer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
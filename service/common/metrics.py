@@ -0,0 +1,150 @@
+"""
+Metrics
+
+Prometheus telemetry of the service: request counts, in-flight requests
+and latency histograms labelled by the flask-restx resource, the method
+and the status, plus the time spent in database queries, the connection
+pool of service/common/pool_metrics.py, the reads
+coalesced by service/common/single_flight.py and the concurrency limits
+and shed requests of service/common/admission.py.
+
+Under gunicorn set PROMETHEUS_MULTIPROC_DIR to a directory shared by the
+workers (gunicorn.conf.py empties it on start and cleans up after dead
+workers) so that /metrics aggregates every worker, not only the one that
+happens to serve the scrape. The directory is created if it is missing,
+so that the flask commands and `flask run` work with the same setting.
+"""
+import os
+import time
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest, multiprocess)
+
+
+
+def prepare_multiprocess_dir():
+    """Creates the directory of the multiprocess mode, which must exist before any metric is written"""
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        os.makedirs(path, exist_ok=True)
+
+
+prepare_multiprocess_dir()
+
+# the statements timed under their own label, the others are "OTHER"
+OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0)
+
+REQUESTS = Counter(
+    "http_requests_total", "Requests served",
+    ["resource", "method", "status"])
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent serving requests",
+    ["resource", "method", "status"])
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests being served",
+    ["resource", "method"], multiprocess_mode="livesum")
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Time spent executing database queries",
+    ["operation"], buckets=DB_BUCKETS)
+DB_POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total", "Connections checked out of the pool")
+DB_POOL_CONNECTS = Counter(
+    "db_pool_connects_total", "Connections opened by the pool")
+DB_POOL_OVERFLOWS = Counter(
+    "db_pool_overflows_total", "Connections opened beyond the size of the pool")
+DB_POOL_INVALIDATIONS = Counter(
+    "db_pool_invalidations_total", "Connections thrown away by the pool")
+DB_POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts_total", "Checkouts that timed out waiting for a connection")
+DB_POOL_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time checkouts waited for a connection",
+    buckets=DB_BUCKETS)
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "Connections of the pool in use, idle, or beyond its size",
+    ["state"], multiprocess_mode="livesum")
+SINGLE_FLIGHT = Counter(
+    "single_flight_calls_total", "Reads executed, or shared with an identical read in flight",
+    ["group", "outcome"])
+ADMISSION_LIMIT = Gauge(
+    "admission_limit", "Requests admitted at once by the adaptive budgets",
+    ["budget"], multiprocess_mode="livesum")
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Requests shed because their budget was full",
+    ["budget"])
+
+# endpoint name -> resource label, filled on first use
+_resources = {}
+
+
+def resource_label(endpoint: str) -> str:
+    """Returns the flask-restx Resource (or view function) serving an endpoint"""
+    label = _resources.get(endpoint)
+    if label is None:
+        view = current_app.view_functions.get(endpoint)
+        view_class = getattr(view, "view_class", None)
+        label = view_class.__name__ if view_class else (endpoint or "unmatched")
+        _resources[endpoint] = label
+    return label
+
+
+def init_app(app):
+    """Times every request served by the Flask app and every database query"""
+    instrument()
+
+    @app.before_request
+    def start_timer():  # pylint: disable=unused-variable
+        g.metrics_labels = (resource_label(request.endpoint), request.method)
+        g.metrics_start = time.perf_counter()
+        IN_FLIGHT.labels(*g.metrics_labels).inc()
+
+    @app.after_request
+    def record_request(response):  # pylint: disable=unused-variable
+        if "metrics_start" in g:
+            labels = g.metrics_labels + (str(response.status_code),)
+            REQUESTS.labels(*labels).inc()
+            REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - g.metrics_start)
+        return response
+
+    @app.teardown_request
+    def stop_timer(error=None):  # pylint: disable=unused-variable
+        if "metrics_labels" in g:
+            IN_FLIGHT.labels(*g.metrics_labels).dec()
+
+
+def instrument():
+    """Times the queries executed through every SQLAlchemy engine"""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "metrics_start", None)
+    if start is None:
+        return
+    operation = statement.lstrip()[:6].upper()
+    if operation not in OPERATIONS:
+        operation = "OTHER"
+    DB_QUERY_LATENCY.labels(operation).observe(time.perf_counter() - start)
+
+
+def render() -> tuple:
+    """Returns the metrics of every worker in the Prometheus text format
+
+    :return: the body and its content type
+    :rtype: tuple
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        prepare_multiprocess_dir()
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
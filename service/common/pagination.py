@@ -0,0 +1,35 @@
+"""
+Pagination helpers
+
+Opaque cursors used for keyset pagination of Product listings.
+A cursor encodes the sort key values of the last row of a page so
+the next page can start right after it without an OFFSET scan.
+"""
+import base64
+import binascii
+import json
+from service.models import DataValidationError
+
+
+def encode_cursor(values: list) -> str:
+    """Encodes the sort key values of a row into an opaque cursor"""
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(cursor: str) -> list:
+    """Decodes a cursor produced by encode_cursor()
+
+    :param cursor: the opaque cursor sent by the client
+    :type cursor: str
+    :return: the sort key values of the last row of the previous page
+    :rtype: list
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, binascii.Error, UnicodeError) as error:
+        raise DataValidationError("Invalid cursor: " + cursor) from error
+    if not isinstance(values, list) or not values:
+        raise DataValidationError("Invalid cursor: " + cursor)
+    return values
@@ -0,0 +1,135 @@
+"""
+Pool Metrics
+
+Instrumentation of the SQLAlchemy connection pool. The pool events count
+checkouts, new connections, overflow connections and invalidations (e.g.
+the stale connections pre-ping throws away after a database failover),
+and InstrumentedQueuePool times how long each checkout waits for a free
+connection, which no pool event reports. The pool of the service (the
+module-level metrics) also exports them to Prometheus.
+"""
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from service.common.metrics import (DB_POOL_CHECKOUTS, DB_POOL_CONNECTIONS, DB_POOL_CONNECTS,
+                                    DB_POOL_INVALIDATIONS, DB_POOL_OVERFLOWS, DB_POOL_TIMEOUTS,
+                                    DB_POOL_WAIT)
+
+
+class PoolMetrics:
+    """Counters of one connection pool"""
+
+    def __init__(self, export: bool = False):
+        """
+        :param export: whether to export the counters to Prometheus as well
+        """
+        self.export = export
+        self.checkouts = self.connects = self.overflows = 0
+        self.invalidations = self.timeouts = 0
+        self.wait_seconds = self.wait_seconds_max = 0.0
+        self.engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """The current pool of the engine (disposing an engine recreates it)"""
+        return self.engine.pool if self.engine is not None else None
+
+    def attach(self, engine):
+        """Listens to the events of the pool of an engine"""
+        self.engine = engine
+        pool = engine.pool
+        if not event.contains(pool, "checkout", self._on_checkout):
+            event.listen(pool, "checkout", self._on_checkout)
+            event.listen(pool, "checkin", self._on_checkin)
+            event.listen(pool, "connect", self._on_connect)
+            event.listen(pool, "invalidate", self._on_invalidate)
+        return self
+
+    def observe_wait(self, seconds: float, timed_out: bool = False):
+        """Records the time a checkout waited for a connection"""
+        with self._lock:
+            self.wait_seconds += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+        if self.export:
+            DB_POOL_WAIT.observe(seconds)
+            if timed_out:
+                DB_POOL_TIMEOUTS.inc()
+
+    def stats(self) -> dict:
+        """Returns the counters and the current state of the pool"""
+        data = {
+            "checkouts": self.checkouts,
+            "connects": self.connects,
+            "overflows": self.overflows,
+            "invalidations": self.invalidations,
+            "timeouts": self.timeouts,
+            "checkout_wait_seconds": round(self.wait_seconds, 6),
+            "checkout_wait_seconds_max": round(self.wait_seconds_max, 6),
+        }
+        if isinstance(self.pool, QueuePool):
+            data.update({
+                "size": self.pool.size(),
+                "in_use": self.pool.checkedout(),
+                "idle": self.pool.checkedin(),
+                "overflow": max(self.pool.overflow(), 0),
+            })
+        return data
+
+    def _export_connections(self):
+        """Sets the gauges of the connections in use, idle and beyond the pool size"""
+        if self.export and isinstance(self.pool, QueuePool):
+            DB_POOL_CONNECTIONS.labels("in_use").set(self.pool.checkedout())
+            DB_POOL_CONNECTIONS.labels("idle").set(self.pool.checkedin())
+            DB_POOL_CONNECTIONS.labels("overflow").set(max(self.pool.overflow(), 0))
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+        if self.export:
+            DB_POOL_CHECKOUTS.inc()
+        self._export_connections()
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        self._export_connections()
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+            # QueuePool counts the connections beyond pool_size as overflow
+            overflow = isinstance(self.pool, QueuePool) and self.pool.overflow() > 0
+            if overflow:
+                self.overflows += 1
+        if self.export:
+            DB_POOL_CONNECTS.inc()
+            if overflow:
+                DB_POOL_OVERFLOWS.inc()
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+        if self.export:
+            DB_POOL_INVALIDATIONS.inc()
+
+
+# The metrics of the connection pool of this worker
+metrics = PoolMetrics(export=True)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that times how long checkouts wait for a connection"""
+
+    metrics = metrics
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.metrics.observe_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.observe_wait(time.perf_counter() - start)
+        return connection
@@ -0,0 +1,126 @@
+"""
+Profiling
+
+On-demand and sampled cProfile profiling of requests, enabled with
+PROFILING_ENABLED. A request sent with the X-Profile-Token header set to
+PROFILING_TOKEN runs under cProfile and its response body is replaced by
+the pstats report. One in PROFILING_SAMPLE_RATE requests (0 disables
+sampling) is profiled in the background. Every profile is also stored
+as a .pstats file in PROFILING_DIR for offline analysis (snakeviz,
+flameprof, gprof2dot ...). Only the newest PROFILING_MAX_FILES are kept.
+"""
+import cProfile
+import hmac
+import io
+import itertools
+import logging
+import os
+import pstats
+import time
+from flask import g, request
+
+logger = logging.getLogger("flask.app")
+
+TOKEN_HEADER = "X-Profile-Token"
+ID_HEADER = "X-Profile-Id"
+
+
+class Profiler:
+    """Runs selected requests under cProfile"""
+
+    def __init__(self):
+        self.enabled = False
+        self.token = ""
+        self.sample_rate = 0
+        self.directory = None
+        self.max_files = 100
+        self.top = 40
+        self._requests = itertools.count(1)
+        self._profiles = itertools.count(1)
+
+    def init_app(self, app):
+        """Reads the PROFILING_* settings and hooks into the requests of the app"""
+        self.enabled = app.config["PROFILING_ENABLED"]
+        self.token = app.config["PROFILING_TOKEN"]
+        self.sample_rate = app.config["PROFILING_SAMPLE_RATE"]
+        self.directory = app.config["PROFILING_DIR"]
+        self.max_files = app.config["PROFILING_MAX_FILES"]
+        app.before_request(self.start)
+        app.after_request(self.stop)
+        app.teardown_request(self.abandon)
+
+    def requested(self) -> bool:
+        """Tells whether the request asked to be profiled with the admin token"""
+        token = request.headers.get(TOKEN_HEADER)
+        return bool(self.token and token and hmac.compare_digest(token, self.token))
+
+    def start(self):
+        """Starts profiling the request when it was asked for or sampled"""
+        if not self.enabled:
+            return
+        on_demand = self.requested()
+        sampled = self.sample_rate > 0 and next(self._requests) % self.sample_rate == 0
+        if on_demand or sampled:
+            g.profile = cProfile.Profile()
+            g.profile_report = on_demand
+            g.profile.enable()
+
+    def stop(self, response):
+        """Stops profiling and stores the profile (and reports it when asked for)"""
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+        profile.disable()
+        name = self.store(profile)
+        if name:
+            response.headers[ID_HEADER] = name
+        if g.profile_report:
+            response.direct_passthrough = False
+            response.set_data(self.report(profile))
+            response.headers.pop("ETag", None)
+            response.mimetype = "text/plain"
+        return response
+
+    @staticmethod
+    def abandon(error=None):
+        """Stops a profile left running by a request that failed"""
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile.disable()
+
+    def report(self, profile) -> str:
+        """Returns the pstats report of the slowest functions by cumulative time"""
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        return stream.getvalue()
+
+    def store(self, profile) -> str:
+        """Writes the profile to the profile directory and rotates the old ones
+
+        :return: the name of the file, or None if it could not be written
+        :rtype: str
+        """
+        if not self.directory:
+            return None
+        name = "{}-{}-{}-{}-{}.pstats".format(
+            time.strftime("%Y%m%dT%H%M%S"), request.endpoint or "unmatched",
+            request.method, os.getpid(), next(self._profiles))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(os.path.join(self.directory, name))
+            self.rotate()
+        except OSError:
+            logger.exception("Could not store the profile %s", name)
+            return None
+        return name
+
+    def rotate(self):
+        """Deletes the oldest profiles beyond max_files"""
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith(".pstats")]
+        if len(paths) <= self.max_files:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_files]:
+            os.remove(path)
@@ -0,0 +1,78 @@
+"""
+Query Log
+
+Per-request SQL accounting. Cursor events on the SQLAlchemy Engine class
+count the queries of each request and the time spent in them, reported
+in the Server-Timing and X-DB-Queries headers of the response so that
+N+1 patterns and regressions show up in production. Statements slower
+than SLOW_QUERY_MS milliseconds are logged with their parameters and the
+route that issued them.
+"""
+import logging
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+# Longest parameter list written to the slow query log
+PARAMETERS_MAX_LENGTH = 1000
+
+
+class QueryLog:
+    """Counts the queries of each request and logs the slow ones"""
+
+    def __init__(self, slow_query_ms: float = 250.0):
+        self.slow_query = slow_query_ms / 1000
+
+    def init_app(self, app):
+        """Wires the cursor events and the response headers into the Flask app"""
+        self.slow_query = app.config["SLOW_QUERY_MS"] / 1000
+        if "query_log" in app.extensions:
+            return
+        app.extensions["query_log"] = self
+        app.before_request(self.start_request)
+        app.after_request(self.add_headers)
+        if not event.contains(Engine, "before_cursor_execute", self.before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+    @staticmethod
+    def start_request():
+        """Resets the SQL counters of the request"""
+        g.db_queries = 0
+        g.db_seconds = 0.0
+        g.request_start = time.perf_counter()
+
+    @staticmethod
+    def add_headers(response):
+        """Reports the SQL counters of the request in the response headers"""
+        if "request_start" not in g:
+            return response
+        total = (time.perf_counter() - g.request_start) * 1000
+        response.headers["X-DB-Queries"] = str(g.db_queries)
+        response.headers["Server-Timing"] = (
+            f'db;dur={g.db_seconds * 1000:.2f};desc="{g.db_queries} queries", total;dur={total:.2f}')
+        return response
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """Notes when a statement starts"""
+        context.query_log_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """Accounts a statement to the current request and logs it when it was slow"""
+        start = getattr(context, "query_log_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        route = None
+        if has_request_context():
+            route = f"{request.method} {request.path}"
+            if "db_queries" in g:
+                g.db_queries += 1
+                g.db_seconds += elapsed
+        if elapsed >= self.slow_query:
+            logger.warning("Slow query (%.1f ms) from %s: %s; parameters: %.*s",
+                           elapsed * 1000, route or "outside of a request", " ".join(statement.split()),
+                           PARAMETERS_MAX_LENGTH, repr(parameters))
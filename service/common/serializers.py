@@ -0,0 +1,121 @@
+"""
+Serializers
+
+Fast serialization of Products for the hot read paths. Rows are read as
+plain tuples (no ORM entities) and shaped into the same JSON documents
+that marshalling with product_model produces, without walking the
+flask-restx field definitions for every row. JSON is encoded with
+orjson when it is installed and with the standard library otherwise.
+"""
+import datetime
+import decimal
+import json
+from service.common import constant
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# The fields of product_model, in the order Product.columns() selects them
+PRODUCT_FIELDS = ("id", "name", "description", "price", "like_num", "is_on_shelf")
+
+
+def _default(value):
+    """Encodes the values JSON does not support natively"""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(data) -> bytes:
+    """Encodes data as compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default)
+    return json.dumps(data, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def loads(data):
+    """Decodes JSON text or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def shape_product(data: dict) -> dict:
+    """Shapes a serialized Product like product_model (the id is a string)"""
+    data = dict(data)
+    if data.get("id") is not None:
+        data["id"] = str(data["id"])
+    return data
+
+
+def parse_fields(value: str) -> tuple:
+    """Parses a comma separated list of Product fields
+
+    :param value: the fields requested by the client, e.g. "id,price"
+    :type value: str
+    :return: the requested fields in order without duplicates
+    :rtype: tuple
+    :raises ValueError: when a field is not a Product field
+    """
+    fields = []
+    for field in value.split(","):
+        field = field.strip()
+        if field not in PRODUCT_FIELDS:
+            raise ValueError(f"Invalid field: {field!r}, expected some of {', '.join(PRODUCT_FIELDS)}")
+        if field not in fields:
+            fields.append(field)
+    return tuple(fields)
+
+
+def parse_ids(value) -> list:
+    """Parses Product ids from a comma separated string or a list
+
+    :param value: the ids requested by the client, e.g. "1,2,3"
+    :return: the ids as integers, in order
+    :rtype: list
+    :raises ValueError: when an id is not an integer that fits the id column
+    """
+    items = value.split(",") if isinstance(value, str) else value
+    if not isinstance(items, list) or not items:
+        raise ValueError("Invalid ids: expected a list of Product ids")
+    ids = []
+    for item in items:
+        if isinstance(item, bool) or not isinstance(item, (int, str)):
+            raise ValueError(f"Invalid id: {item!r}")
+        try:
+            product_id = int(item)
+        except ValueError as error:
+            raise ValueError(f"Invalid id: {item!r}") from error
+        # larger ids cannot exist and would not fit the INTEGER column in the query
+        if not constant.INTEGER_MIN <= product_id <= constant.INTEGER_MAX:
+            raise ValueError(f"Invalid id: {item!r}")
+        ids.append(product_id)
+    return ids
+
+
+def iter_products(rows, fields=PRODUCT_FIELDS, output=None):
+    """Shapes row tuples selected in the order of fields like product_model,
+    one at a time so that streamed rows are never all held in memory
+
+    :param output: the fields to keep when extra columns (like sort keys)
+                   were selected only for pagination
+    """
+    if output is None or tuple(output) == tuple(fields):
+        output = None
+    with_id = "id" in fields and (output is None or "id" in output)
+    for row in rows:
+        product = dict(zip(fields, row))
+        if output is not None:
+            product = {field: product[field] for field in output}
+        if with_id and product["id"] is not None:
+            product["id"] = str(product["id"])
+        yield product
+
+
+def rows_to_products(rows, fields=PRODUCT_FIELDS, output=None) -> list:
+    """Shapes row tuples selected in the order of fields like product_model"""
+    return list(iter_products(rows, fields, output))
@@ -0,0 +1,104 @@
+"""
+Single Flight
+
+Coalesces concurrent identical reads within a worker: the first caller
+of a key runs the read, and the callers that ask for the same key while
+it is running wait for it and share its result (or its exception)
+instead of sending the same query to the database. Nothing is kept once
+the read returns; caching is the job of service/common/cache.py.
+
+Every group counts the reads it executed and the ones it shared, in the
+single_flight_calls_total Prometheus counter and in /health/single-flight;
+the coalescing ratio is shared / (executed + shared).
+"""
+import threading
+from service.common.metrics import SINGLE_FLIGHT
+
+# every group, by name, for the health report
+GROUPS = {}
+
+
+class _Flight:  # pylint: disable=too-few-public-methods
+    """A read in progress"""
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """A group of reads coalesced by key"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.executed = self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        GROUPS[name] = self
+
+    def do(self, key, function, *args):
+        """Returns function(*args), or the result of the same read already in flight
+
+        :param key: a hashable key identifying the read and its arguments
+        :param function: the read to run when none is in flight for the key
+        :raises: the exception of the read, in every caller that shared it
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.executed += 1
+            else:
+                self.shared += 1
+        SINGLE_FLIGHT.labels(self.name, "executed" if leader else "shared").inc()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args)
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            self.forget(key, flight)
+            flight.done.set()
+
+    def forget(self, key, flight=None):
+        """Lets the next caller of a key start a new read (after a write)"""
+        with self._lock:
+            if flight is None or self._flights.get(key) is flight:
+                self._flights.pop(key, None)
+
+    def forget_all(self, match=None):
+        """Lets the next callers of every key, or of the keys match(key) selects, start new reads
+
+        The reads in flight still answer the callers that already joined them
+        """
+        with self._lock:
+            if match is None:
+                self._flights.clear()
+            else:
+                for key in [key for key in self._flights if match(key)]:
+                    del self._flights[key]
+
+    def stats(self) -> dict:
+        """Returns the reads executed and shared, and the coalescing ratio"""
+        with self._lock:
+            executed, shared = self.executed, self.shared
+        calls = executed + shared
+        return {
+            "executed": executed,
+            "shared": shared,
+            "ratio": shared / calls if calls else 0.0,
+        }
+
+
+def stats() -> dict:
+    """Returns the counters of every group"""
+    return {name: group.stats() for name, group in GROUPS.items()}
@@ -12,5 +12,87 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Database connection pool (pre-ping and recycle replace the connections
+# left stale by a database failover or an idle timeout)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+
+# Statements slower than this many milliseconds are logged with their parameters
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "250"))
+
+# Profiling of requests sent with the X-Profile-Token header and of one in
+# PROFILING_SAMPLE_RATE requests (0 disables sampling)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("true", "1", "yes")
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_SAMPLE_RATE = int(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_DIR = os.getenv("PROFILING_DIR", "/tmp/profiles")
+PROFILING_MAX_FILES = int(os.getenv("PROFILING_MAX_FILES", "100"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Keyset pagination of Product listings
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Number of rows fetched per round trip when streaming Product listings
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+
+# Bulk creation of Products
+BATCH_SIZE_MAX = int(os.getenv("BATCH_SIZE_MAX", "50000"))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "1000"))
+
+# Reject the updates of Products sent without If-Match (428) instead of
+# overwriting whatever version is current
+PUT_REQUIRE_IF_MATCH = os.getenv("PUT_REQUIRE_IF_MATCH", "false").lower() in ("true", "1", "yes")
+
+# Most ids looked up in one request (GET ?ids= or POST /products:lookup)
+LOOKUP_IDS_MAX = int(os.getenv("LOOKUP_IDS_MAX", "10000"))
+
+# Server-Sent Events of Product changes: NOTIFY channel, events buffered per
+# client before it is disconnected, and seconds between keep-alive comments
+EVENTS_CHANNEL = os.getenv("EVENTS_CHANNEL", "product_events")
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_KEEPALIVE = float(os.getenv("EVENTS_KEEPALIVE", "15"))
+
+# Leaderboard of the most liked Products: largest n served from memory and
+# most seconds between two reads of the top of the table
+TOP_MAX_N = int(os.getenv("TOP_MAX_N", "100"))
+TOP_REFRESH = float(os.getenv("TOP_REFRESH", "60"))
+
+# Write-behind buffering of like/unlike actions
+LIKE_BUFFER_ENABLED = os.getenv("LIKE_BUFFER_ENABLED", "false").lower() in ("true", "1", "yes")
+LIKE_BUFFER_FLUSH_MS = int(os.getenv("LIKE_BUFFER_FLUSH_MS", "200"))
+LIKE_BUFFER_MAX_EVENTS = int(os.getenv("LIKE_BUFFER_MAX_EVENTS", "1000"))
+
+# Read-through cache of Products (set CACHE_URL to share it through Redis)
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "4096"))
+
+# Product statistics are cached for a few seconds (in Redis too when CACHE_URL is set)
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "10"))
+STATS_BUCKETS_MAX = int(os.getenv("STATS_BUCKETS_MAX", "100"))
+
+# Admission control: requests served at once per worker for each class of
+# request (adaptive below these limits), mean query latency above which
+# the limits shrink, by what factor, the Retry-After of shed requests and
+# how long /health reports the worker overloaded after shedding one
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("true", "1", "yes")
+ADMISSION_READ_LIMIT = int(os.getenv("ADMISSION_READ_LIMIT", "32"))
+ADMISSION_WRITE_LIMIT = int(os.getenv("ADMISSION_WRITE_LIMIT", "16"))
+ADMISSION_BULK_LIMIT = int(os.getenv("ADMISSION_BULK_LIMIT", "2"))
+ADMISSION_LATENCY_MS = float(os.getenv("ADMISSION_LATENCY_MS", "100"))
+ADMISSION_BACKOFF = float(os.getenv("ADMISSION_BACKOFF", "0.9"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+ADMISSION_HEALTH_WINDOW = float(os.getenv("ADMISSION_HEALTH_WINDOW", "5"))
@@ -0,0 +1,200 @@
+"""
+Schema Migrations
+
+Versioned DDL for the products database. Migrations are applied once,
+in order, by the `flask db-upgrade` command (run it as a deploy step
+before the workers start); the workers themselves never issue DDL.
+
+Every applied version is recorded in the schema_migrations table and
+concurrent runs are serialized with a PostgreSQL advisory lock.
+Migrations that cannot run inside a transaction (CREATE INDEX
+CONCURRENTLY) are marked transactional=False and run in autocommit.
+To change the schema append a new Migration; never edit an applied one.
+"""
+import logging
+from collections import namedtuple
+from sqlalchemy import text
+from service.common import constant
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+# Arbitrary key of the advisory lock held while migrating
+LOCK_KEY = 28200003
+
+Migration = namedtuple("Migration", ["version", "description", "statements", "transactional"],
+                       defaults=[True])
+
+MIGRATIONS = [
+    Migration(1, "Create the product table and its full-text indexes", [
+        f"""
+        CREATE TABLE IF NOT EXISTS product (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR({constant.LENGTH_MAX_PRODUCT_NAME}) NOT NULL,
+            description VARCHAR({constant.LENGTH_MAX_PRODUCT_DESC}),
+            price INTEGER NOT NULL,
+            like_num INTEGER,
+            is_on_shelf BOOLEAN
+        )
+        """,
+        f"""
+        ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('{constant.SEARCH_CONFIG}', coalesce(name, '')), 'A') ||
+                setweight(to_tsvector('{constant.SEARCH_CONFIG}', coalesce(description, '')), 'B')
+            ) STORED
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_product_search_vector ON product USING gin (search_vector)",
+        f"""
+        CREATE INDEX IF NOT EXISTS ix_product_description_fts ON product
+            USING gin (to_tsvector('{constant.SEARCH_CONFIG}', coalesce(description, '')))
+        """,
+    ]),
+    Migration(2, "Index the name, price and is_on_shelf query paths", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_name ON product (name)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_price ON product (price)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_on_shelf ON product (id) WHERE is_on_shelf",
+    ], transactional=False),
+    Migration(3, "Add composite indexes for combined filters and sort orders", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_name_price ON product (name, price, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_on_shelf_price ON product (price, id) WHERE is_on_shelf",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_like_num ON product (like_num, id)",
+    ], transactional=False),
+    Migration(4, "Track changes and deletions of Products for the change feed", [
+        "CREATE SEQUENCE IF NOT EXISTS product_change_seq",
+        """
+        ALTER TABLE product
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            ADD COLUMN IF NOT EXISTS change_txid BIGINT NOT NULL DEFAULT txid_current(),
+            ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT nextval('product_change_seq')
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS product_tombstone (
+            id INTEGER PRIMARY KEY,
+            deleted_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            change_txid BIGINT NOT NULL DEFAULT txid_current(),
+            change_seq BIGINT NOT NULL DEFAULT nextval('product_change_seq')
+        )
+        """,
+        # every write path (ORM, bulk SQL, COPY imports) stamps the rows it changes
+        """
+        CREATE OR REPLACE FUNCTION product_track_change() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := now();
+            NEW.change_txid := txid_current();
+            NEW.change_seq := nextval('product_change_seq');
+            IF TG_OP = 'INSERT' THEN
+                DELETE FROM product_tombstone WHERE id = NEW.id;
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION product_track_delete() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO product_tombstone (id) VALUES (OLD.id)
+            ON CONFLICT (id) DO UPDATE SET
+                deleted_at = now(), change_txid = txid_current(),
+                change_seq = nextval('product_change_seq');
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS product_track_change ON product",
+        """
+        CREATE TRIGGER product_track_change BEFORE INSERT OR UPDATE ON product
+            FOR EACH ROW EXECUTE FUNCTION product_track_change()
+        """,
+        "DROP TRIGGER IF EXISTS product_track_delete ON product",
+        """
+        CREATE TRIGGER product_track_delete AFTER DELETE ON product
+            FOR EACH ROW EXECUTE FUNCTION product_track_delete()
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_product_change ON product (change_txid, change_seq)",
+        """
+        CREATE INDEX IF NOT EXISTS ix_product_tombstone_change
+            ON product_tombstone (change_txid, change_seq)
+        """,
+    ]),
+    Migration(5, "Index the most liked Products on shelf", [
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_on_shelf_likes
+            ON product (like_num DESC NULLS LAST, id) WHERE is_on_shelf
+        """,
+    ], transactional=False),
+    Migration(6, "Version Products for optimistic concurrency", [
+        "ALTER TABLE product ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+        # every update bumps it, whatever the write path, so If-Match sees every change
+        """
+        CREATE OR REPLACE FUNCTION product_bump_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := OLD.version + 1;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS product_bump_version ON product",
+        """
+        CREATE TRIGGER product_bump_version BEFORE UPDATE ON product
+            FOR EACH ROW EXECUTE FUNCTION product_bump_version()
+        """,
+    ]),
+    # a NULL like_num sorted apart from every number and broke the keyset
+    # pagination of listings sorted by like_num
+    Migration(7, "Count missing likes as zero", [
+        "ALTER TABLE product ALTER COLUMN like_num SET DEFAULT 0",
+        "UPDATE product SET like_num = 0 WHERE like_num IS NULL",
+        "ALTER TABLE product ALTER COLUMN like_num SET NOT NULL",
+    ]),
+]
+
+
+def applied_versions(connection) -> set:
+    """Returns the versions already applied to the database"""
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+    return {row.version for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def upgrade(engine=None) -> list:
+    """Applies every pending migration in order
+
+    :param engine: the engine of the database to migrate (db.engine by default)
+    :return: the versions that were applied
+    :rtype: list
+    """
+    engine = engine or db.engine
+    applied = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock:
+        lock.execute(text("SELECT pg_advisory_lock(:key)"), {"key": LOCK_KEY})
+        try:
+            done = applied_versions(lock)
+            for migration in MIGRATIONS:
+                if migration.version in done:
+                    continue
+                logger.info("Applying migration %d: %s", migration.version, migration.description)
+                if migration.transactional:
+                    with engine.begin() as connection:
+                        _apply(connection, migration)
+                else:
+                    _apply(lock, migration)
+                applied.append(migration.version)
+        finally:
+            lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+    logger.info("Database schema is at version %d", MIGRATIONS[-1].version)
+    return applied
+
+
+def _apply(connection, migration: Migration):
+    """Runs the statements of a migration and records its version"""
+    for statement in migration.statements:
+        connection.execute(text(statement))
+    connection.execute(
+        text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+        {"version": migration.version, "description": migration.description})
@@ -10,10 +10,19 @@ id: integer - the id of the product (primary key)
 name: string - the name of the product
 description: string - the description for the product
 price: integer - the price of the product
+like_num: integer - the number of likes of the product
+is_on_shelf: boolean - whether the product is for sale
+search_vector: tsvector - weighted full-text index of name and description
+version: integer - bumped by every update, for optimistic concurrency (If-Match)
 """
 import logging
-from service.common import constant
+from service.common import cache, constant, pool_metrics
+from service.common.single_flight import SingleFlight
+from service.common.serializers import PRODUCT_FIELDS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (Integer, and_, any_, bindparam, cast, column, desc, func, insert, literal,
+                        literal_column, null, or_, select, true, tuple_, union_all, update, values)
+from sqlalchemy.dialects.postgresql import ARRAY, REAL, TSVECTOR
 from flask import Flask
 
 logger = logging.getLogger("flask.app")
@@ -21,12 +30,32 @@ logger = logging.getLogger("flask.app")
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Text search configuration used by the full-text indexes
+SEARCH_CONFIG = literal_column(f"'{constant.SEARCH_CONFIG}'")
+
+# Columns Product listings can be sorted (and paginated) by
+SORT_KEYS = ("id", "name", "price", "like_num")
+
+# The serialized fields of a Product plus its version, as lookup() returns them
+VERSIONED_FIELDS = PRODUCT_FIELDS + ("version",)
+
 
 def init_db(app):
     # Initialize the SQLAlchemy app
     Product.init_db(app)
 
 
+# Products deleted since a change feed client last synced (see Product.changes)
+product_tombstone = db.Table(
+    "product_tombstone",
+    db.Column("id", db.Integer, primary_key=True),
+    db.Column("deleted_at", db.DateTime(timezone=True), nullable=False, server_default=func.now()),
+    db.Column("change_txid", db.BigInteger, nullable=False),
+    db.Column("change_seq", db.BigInteger, nullable=False),
+    db.Index("ix_product_tombstone_change", "change_txid", "change_seq"),
+)
+
+
 class DatabaseConnectionError(Exception):
     """Custom Exception when database connection fails"""
 
@@ -41,16 +70,45 @@ class Product(db.Model):
     """
 
     app = None
+    cache = None  # read-through cache of serialized Products, see init_db()
+    flights = SingleFlight("product")  # concurrent reads of a Product share one query
+    events = None  # notifies the changes in the transaction of the write, see notify()
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(
-        db.String(constant.LENGTH_MAX_PRODUCT_NAME), nullable=False)
+        db.String(constant.LENGTH_MAX_PRODUCT_NAME), nullable=False, index=True)
     description = db.Column(
         db.String(constant.LENGTH_MAX_PRODUCT_DESC))
-    price = db.Column(db.Integer, default=0, nullable=False)
-    like_num = db.Column(db.Integer, default=0)
+    price = db.Column(db.Integer, default=0, nullable=False, index=True)
+    like_num = db.Column(db.Integer, default=0, nullable=False, server_default="0")
     is_on_shelf = db.Column(db.Boolean, default=True)
+    search_vector = db.deferred(db.Column(TSVECTOR, db.Computed(
+        f"setweight(to_tsvector('{constant.SEARCH_CONFIG}', coalesce(name, '')), 'A') || "
+        f"setweight(to_tsvector('{constant.SEARCH_CONFIG}', coalesce(description, '')), 'B')",
+        persisted=True)))
+    # stamped by a trigger on every write, see changes()
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+    change_txid = db.deferred(db.Column(db.BigInteger, nullable=False,
+                                        server_default=func.txid_current()))
+    change_seq = db.Column(db.BigInteger, nullable=False,
+                           server_default=func.nextval("product_change_seq"))
+    # bumped by a trigger on every update, see replace()
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    # The schema is created by service/migrations.py; keep these in step with it
+    __table_args__ = (
+        db.Index("ix_product_on_shelf", id, postgresql_where=is_on_shelf),
+        db.Index("ix_product_name_price", name, price, id),
+        db.Index("ix_product_on_shelf_price", price, id, postgresql_where=is_on_shelf),
+        db.Index("ix_product_like_num", like_num, id),
+        db.Index("ix_product_on_shelf_likes", like_num.desc().nullslast(), id, postgresql_where=is_on_shelf),
+        db.Index("ix_product_search_vector", search_vector, postgresql_using="gin"),
+        db.Index("ix_product_description_fts",
+                 func.to_tsvector(SEARCH_CONFIG, func.coalesce(description, "")),
+                 postgresql_using="gin"),
+        db.Index("ix_product_change", change_txid, change_seq),
+    )
 
     def __repr__(self):
         return f"<Product {self.name} id=[{self.id}]>"
@@ -62,22 +120,166 @@ class Product(db.Model):
         logger.info("Creating %s", self.name)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
+        db.session.flush()
+        self.notify(self.serialize())
         db.session.commit()
 
-    def update(self):
+    @classmethod
+    def create_many(cls, products: list, chunk_size: int = 1000) -> list:
+        """
+        Creates Products with multi-row INSERTs inside a single transaction
+        :param products: the Products to create
+        :type products: list
+        :param chunk_size: the number of rows sent per INSERT statement
+        :type chunk_size: int
+        :return: the ids assigned to the Products, in the same order
+        :rtype: list
+        """
+        logger.info("Creating %d products", len(products))
+        table = cls.__table__
+        ids = []
+        try:
+            for start in range(0, len(products), chunk_size):
+                rows = [product.serialize() for product in products[start:start + chunk_size]]
+                for row in rows:
+                    del row["id"]  # id must be none to generate next primary key
+                result = db.session.execute(insert(table).values(rows).returning(table.c.id))
+                ids.extend(row.id for row in result)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for product, product_id in zip(products, ids):
+            product.id = product_id
+        return ids
+
+    def update(self) -> dict:
         """
         Updates a Product to the database
+        :return: the Product as written, serialized (without reading it back)
+        :rtype: dict
         """
         logger.info("Saving %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
+        data = self.serialize()
+        self.notify(data)
         db.session.commit()
+        self.forget(data["id"])
+        return data
+
+    @classmethod
+    def replace(cls, product_id: int, data: dict, versions=None) -> dict:
+        """
+        Overwrites a Product in a single conditional UPDATE
+        :param product_id: the id of the Product to overwrite
+        :type product_id: int
+        :param data: the new Product, as for deserialize()
+        :type data: dict
+        :param versions: the versions the client may overwrite (from If-Match),
+                         None to overwrite any version
+        :type versions: list
+        :return: the updated Product with its new version, or None when no
+                 Product has that id (and one of those versions)
+        :rtype: dict
+        """
+        logger.info("Replacing id %s ...", product_id)
+        product = cls()
+        product.deserialize(data)
+        table = cls.__table__
+        statement = update(table).where(table.c.id == product_id)
+        if versions is not None:
+            statement = statement.where(table.c.version.in_(versions))
+        result = db.session.execute(
+            statement
+            .values({field: getattr(product, field) for field in PRODUCT_FIELDS if field != "id"})
+            .returning(*cls.columns(VERSIONED_FIELDS))
+        )
+        row = result.first() if result.rowcount else None
+        if row:
+            cls.notify(dict(zip(PRODUCT_FIELDS, row)))
+        db.session.commit()
+        if not row:
+            return None
+        cls.forget(product_id)
+        return dict(zip(VERSIONED_FIELDS, row))
+
+    @classmethod
+    def current_version(cls, product_id: int):
+        """Returns the version of a Product, or None if not found"""
+        return db.session.query(cls.version).filter(cls.id == product_id).scalar()
+
+    @classmethod
+    def add_likes(cls, product_id: int, delta: int):
+        """
+        Atomically adds to the like_num of a Product in a single UPDATE
+        :param product_id: the id of the Product to like or unlike
+        :type product_id: int
+        :param delta: the number of likes to add (negative to remove likes)
+        :type delta: int
+        :return: the updated Product as a dictionary, or None if not found
+        :rtype: dict
+        """
+        logger.info("Adding %s likes to id %s ...", delta, product_id)
+        table = cls.__table__
+        result = db.session.execute(
+            update(table)
+            .where(table.c.id == product_id)
+            .values(like_num=func.coalesce(table.c.like_num, 0) + delta)
+            .returning(cls.id, cls.name, cls.description, cls.price,
+                       cls.like_num, cls.is_on_shelf)
+        )
+        row = result.first() if result.rowcount else None
+        if row:
+            cls.notify(dict(row._mapping))
+        db.session.commit()
+        if not row:
+            return None
+        cls.forget(row.id)
+        return dict(row._mapping)
+
+    @classmethod
+    def apply_like_deltas(cls, deltas: dict):
+        """
+        Adds many like deltas to Products in a single batched UPDATE, and
+        notifies each updated Product once
+        :param deltas: the number of likes to add keyed by Product id
+        :type deltas: dict
+        """
+        logger.info("Adding likes to %d products ...", len(deltas))
+        table = cls.__table__
+        pending = values(column("id", Integer), column("delta", Integer), name="deltas")
+        pending = pending.data(list(deltas.items()))
+        rows = db.session.execute(
+            update(table)
+            .where(table.c.id == pending.c.id)
+            .values(like_num=func.coalesce(table.c.like_num, 0) + pending.c.delta)
+            .returning(*cls.columns())
+        )
+        for row in rows:
+            cls.notify(dict(zip(PRODUCT_FIELDS, row)))
+        db.session.commit()
+        for product_id in deltas:
+            cls.forget(product_id)
 
     def delete(self):
         """ Removes a Product from the data store """
         logger.info("Deleting %s", self.name)
+        product_id = self.id
         db.session.delete(self)
+        self.notify({"id": product_id}, deleted=True)
         db.session.commit()
+        self.forget(product_id)
+
+    @classmethod
+    def notify(cls, data: dict, deleted: bool = False):
+        """Sends the change of a Product in the transaction that writes it
+
+        The event is delivered when the write commits, in commit order, and
+        never when it rolls back (see service/common/events.py)
+        """
+        if cls.events is not None:
+            cls.events.publish(data, deleted)
 
     def serialize(self):
         """ Serializes a Product into a dictionary """
@@ -114,7 +316,7 @@ class Product(db.Model):
                     "Invalid Product: invalid type for price: "
                     + str(type(data['price'] + " instead of [int/float]"))
                 )
-            self.like_num = data.get('like_num', 0)
+            self.like_num = data.get('like_num') or 0  # null likes are no likes
             self.is_on_shelf = data.get('is_on_shelf', True)
         except KeyError as error:
             raise DataValidationError(
@@ -130,15 +332,36 @@ class Product(db.Model):
     def init_db(cls, app: Flask):
         """ Initializes the database session
 
+        The tables are not created here: run `flask db-upgrade` to apply
+        the schema migrations before starting the service
+
         :param app: the Flask app
         :type data: Flask
         """
         logger.info("Initializing database")
+        # time the pool checkouts, see service/common/pool_metrics.py
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(
+            app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+            poolclass=pool_metrics.InstrumentedQueuePool)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        # db.drop_all()
-        db.create_all()  # make our sqlalchemy tables
+        pool_metrics.metrics.attach(db.engine)
+        cls.cache = cache.from_config(app.config)
+        cls.stats_cache = cache.from_config(app.config, ttl=app.config["STATS_CACHE_TTL"],
+                                            prefix="product-stats:")
+
+    @classmethod
+    def columns(cls, fields=PRODUCT_FIELDS) -> list:
+        """Returns the columns of the serialized fields of a Product, in order
+
+        Select them with query.with_entities() to read plain row tuples
+        instead of building ORM entities
+
+        :param fields: the fields to select (every field by default)
+        :type fields: tuple
+        """
+        return [getattr(cls, field) for field in fields]
 
     @classmethod
     def all(cls) -> list:
@@ -157,6 +380,94 @@ class Product(db.Model):
         logger.info("Processing lookup for id %s ...", product_id)
         return cls.query.get(product_id)
 
+    @classmethod
+    def find_many(cls, product_ids, fields=PRODUCT_FIELDS) -> tuple:
+        """Finds many Products by their ids in one query
+
+        :param product_ids: the ids of the Products to find
+        :type product_ids: list
+        :param fields: the fields to return (every field by default)
+        :type fields: tuple
+        :return: the serialized Products found, in the order of product_ids
+                 without duplicates, and the ids that were not found
+        :rtype: tuple
+        """
+        logger.info("Processing lookup of %d ids ...", len(product_ids))
+        product_ids = list(dict.fromkeys(product_ids))
+        selected = ("id",) + tuple(field for field in fields if field != "id")
+        # one array parameter (= ANY) instead of one parameter per id (IN)
+        rows = cls.query.with_entities(*cls.columns(selected)).filter(
+            cls.id == any_(bindparam("ids", product_ids, type_=ARRAY(Integer)))).all()
+        found = {row[0]: row for row in rows}
+        products, missing = [], []
+        for product_id in product_ids:
+            row = found.get(product_id)
+            if row is None:
+                missing.append(product_id)
+                continue
+            product = dict(zip(selected, row))
+            products.append({field: product[field] for field in fields})
+        return products, missing
+
+    @staticmethod
+    def cache_key(product_id) -> str:
+        """Returns the key a Product is cached under"""
+        return f"product:{product_id}"
+
+    @classmethod
+    def lookup(cls, product_id, fields=None) -> dict:
+        """Finds a serialized Product by it's ID through the cache
+
+        When only some fields are requested they are selected directly
+        and the cache is bypassed. Concurrent reads of the same Product
+        share one query (see service/common/single_flight.py)
+
+        :param product_id: the id of the Product to find
+        :type product_id: int
+        :param fields: the fields to return (every field by default)
+        :type fields: tuple
+        :return: the serialized Product with its version, or None if not found
+        :rtype: dict
+        """
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            return None
+        if fields is not None and tuple(fields) != PRODUCT_FIELDS:
+            fields = tuple(fields) + ("version",)
+            data = cls.flights.do((product_id, fields), cls.read, product_id, fields)
+            return dict(data) if data else None
+        key = cls.cache_key(product_id)
+        data = cls.cache.get(key)
+        if data is None or "version" not in data:
+            data = cls.flights.do((product_id, VERSIONED_FIELDS), cls.read, product_id, VERSIONED_FIELDS, key)
+            if not data:
+                return None
+        return dict(data)
+
+    @classmethod
+    def read(cls, product_id: int, fields=PRODUCT_FIELDS, key: str = None) -> dict:
+        """Reads the fields of a Product from the database, and caches them under key
+
+        :return: the fields of the Product, or None if not found
+        :rtype: dict
+        """
+        # taken before the query, so that a write committed meanwhile keeps the row out
+        generation = cls.cache.generation(key) if key is not None else None
+        row = cls.query.with_entities(*cls.columns(fields)).filter(cls.id == product_id).first()
+        if not row:
+            return None
+        data = dict(zip(fields, row))
+        if key is not None:
+            cls.cache.set(key, data, generation)
+        return data
+
+    @classmethod
+    def forget(cls, product_id: int):
+        """Drops a written Product from the cache, and lets the next reads query it again"""
+        cls.cache.delete(cls.cache_key(product_id))
+        cls.flights.forget_all(lambda key: key[0] == product_id)
+
     @classmethod
     def find_or_404(cls, product_id: int):
         """Find a Product by it's id
@@ -192,11 +503,302 @@ class Product(db.Model):
 
     @classmethod
     def find_by_description(cls, description: str) -> list:
-        """Returns all Products with the given description
-        :param description: the description of the Products you want to match
+        """Returns all Products whose description contains the given words
+        :param description: the words of the description you want to match
         :type description: str
         :return: a collection of Products with that description
         :rtype: list
         """
         logger.info("Processing description query for %s ...", description)
-        return cls.query.filter(cls.description.like(f"%{description}%"))
+        return cls.query.filter(cls.description_matches(description))
+
+    @classmethod
+    def search(cls, text: str) -> list:
+        """Returns the Products matching a full-text query, best matches first
+        :param text: the search terms, in web search syntax
+        :type text: str
+        :return: a collection of matching Products ranked by relevance
+        :rtype: list
+        """
+        logger.info("Processing full-text search for %s ...", text)
+        return cls.query.filter(cls.search_matches(text)).order_by(
+            cls.search_rank(text).desc(), cls.id)
+
+    @classmethod
+    def find_by_filters(cls, name: str = None, price_min: int = None, price_max: int = None,
+                        description: str = None, q: str = None, is_on_shelf: bool = None,
+                        like_min: int = None, like_max: int = None,
+                        sort: str = None, descending: bool = False):
+        """Returns the Products matching every given filter in a single query
+        :param name: the exact name of the Products
+        :param price_min: the lowest price of the Products
+        :param price_max: the highest price of the Products
+        :param description: words the description must contain
+        :param q: full-text search terms for the name and description
+        :param is_on_shelf: whether the Products are for sale
+        :param like_min: the lowest like_num of the Products
+        :param like_max: the highest like_num of the Products
+        :param sort: one of SORT_KEYS; full-text searches are ranked by
+                     relevance and other queries sorted by id by default
+        :param descending: sort in descending order
+        :return: a query of the matching Products
+        """
+        logger.info("Processing filtered query sorted by %s ...", sort)
+        conditions = []
+        if name is not None:
+            conditions.append(cls.name == name)
+        if price_min is not None:
+            conditions.append(cls.price >= price_min)
+        if price_max is not None:
+            conditions.append(cls.price <= price_max)
+        if description:
+            conditions.append(cls.description_matches(description))
+        if q:
+            conditions.append(cls.search_matches(q))
+        if is_on_shelf is not None:
+            conditions.append(cls.is_on_shelf == is_on_shelf)
+        if like_min is not None:
+            conditions.append(cls.like_num >= like_min)
+        if like_max is not None:
+            conditions.append(cls.like_num <= like_max)
+        query = cls.query.filter(*conditions)
+        if q and sort is None:
+            return query.order_by(cls.search_rank(q).desc(), cls.id)
+        return query.order_by(*cls.sort_order(sort or "id", descending))
+
+    @classmethod
+    def description_matches(cls, description: str):
+        """Returns the condition of a description containing the given words"""
+        document = func.to_tsvector(SEARCH_CONFIG, func.coalesce(cls.description, ""))
+        return document.op("@@")(func.plainto_tsquery(SEARCH_CONFIG, description))
+
+    @classmethod
+    def search_matches(cls, text: str):
+        """Returns the condition of a Product matching a full-text query"""
+        return cls.search_vector.op("@@")(func.websearch_to_tsquery(SEARCH_CONFIG, text))
+
+    @classmethod
+    def search_rank(cls, text: str):
+        """Returns the relevance of a Product for a full-text query"""
+        return func.ts_rank(cls.search_vector, func.websearch_to_tsquery(SEARCH_CONFIG, text))
+
+    @classmethod
+    def sort_order(cls, sort: str, descending: bool = False) -> list:
+        """Returns the ORDER BY clauses of a sort key, ties broken by id"""
+        if sort not in SORT_KEYS:
+            raise DataValidationError("Invalid sort key: " + str(sort))
+        order = [cls.id] if sort == "id" else [getattr(cls, sort), cls.id]
+        return [column.desc() for column in order] if descending else order
+
+    @classmethod
+    def catalog_version(cls) -> str:
+        """Returns a token that changes whenever a Product is written or deleted
+
+        It is read from the newest change of the change feed (see changes())
+        through the change indexes, without reading any listing. A write of
+        a transaction older than that change, still running, would land
+        behind it when it commits, so the ids of those transactions are part
+        of the token too.
+
+        :return: the token, e.g. "1234.56" or "1234.56.1230"
+        :rtype: str
+        """
+        tombstone = product_tombstone.c
+        newest = union_all(
+            select(cls.change_txid, cls.change_seq)
+            .order_by(cls.change_txid.desc(), cls.change_seq.desc()).limit(1),
+            select(tombstone.change_txid, tombstone.change_seq)
+            .order_by(tombstone.change_txid.desc(), tombstone.change_seq.desc()).limit(1),
+            select(literal(0), literal(0)),  # an empty catalog
+        ).order_by(desc("change_txid"), desc("change_seq")).limit(1).subquery()
+        snapshot, txid, seq = db.session.execute(
+            select(func.txid_current_snapshot(), newest.c.change_txid, newest.c.change_seq)).one()
+        running = [xid for xid in str(snapshot).split(":")[2].split(",") if xid and int(xid) < txid]
+        return ".".join([str(txid), str(seq)] + running)
+
+    @classmethod
+    def changes(cls, after: list = None, limit: int = 100) -> tuple:
+        """Returns the Products changed and deleted since a change feed cursor
+
+        Changes are ordered by the id of the transaction that made them, and
+        only the transactions older than every transaction still running are
+        returned, so a change committed late can never land behind a cursor
+        that was already handed out.
+
+        :param after: the cursor returned by the previous call (None to start over)
+        :type after: list
+        :param limit: the maximum number of changes to return
+        :type limit: int
+        :return: the changes (Products and tombstones), the cursor to pass
+                 next time and whether more changes are ready
+        :rtype: tuple
+        """
+        after = after or [0, 0]
+        if len(after) != 2 or not all(
+                isinstance(value, int) and not isinstance(value, bool)
+                and constant.BIGINT_MIN <= value <= constant.BIGINT_MAX for value in after):
+            raise DataValidationError("Invalid change feed cursor")
+        logger.info("Processing %s changes after %s ...", limit, after)
+        horizon = db.session.execute(
+            select(func.txid_snapshot_xmin(func.txid_current_snapshot()))).scalar()
+        tombstone = product_tombstone.c
+        live = select(cls.change_txid, cls.change_seq, literal(False).label("deleted"),
+                      cls.updated_at, *cls.columns()).where(
+            tuple_(cls.change_txid, cls.change_seq) > tuple_(*after), cls.change_txid < horizon)
+        dead = select(tombstone.change_txid, tombstone.change_seq, literal(True), tombstone.deleted_at,
+                      tombstone.id, *(cast(null(), column.type) for column in cls.columns()[1:])).where(
+            tuple_(tombstone.change_txid, tombstone.change_seq) > tuple_(*after),
+            tombstone.change_txid < horizon)
+        query = union_all(live, dead).order_by("change_txid", "change_seq").limit(limit + 1)
+        rows = db.session.execute(query).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor, more = [rows[-1].change_txid, rows[-1].change_seq], True
+        else:
+            # every transaction before the horizon has been returned
+            cursor, more = max([horizon, 0], after), False
+        changes = []
+        for row in rows:
+            change = {"id": row.id, "deleted": row.deleted, "change_seq": row.change_seq,
+                      "updated_at": row.updated_at}
+            if not row.deleted:
+                change.update(zip(PRODUCT_FIELDS, row[4:]))
+            changes.append(change)
+        return changes, cursor, more
+
+    @classmethod
+    def top_liked(cls, limit: int) -> list:
+        """Returns the most liked Products on shelf, ties broken by id
+        :param limit: the number of Products to return
+        :type limit: int
+        :return: the Products as dictionaries, most liked first
+        :rtype: list
+        """
+        logger.info("Processing top %s liked products ...", limit)
+        rows = cls.query.filter(cls.is_on_shelf).order_by(
+            cls.like_num.desc().nullslast(), cls.id).limit(limit).with_entities(*cls.columns())
+        return [dict(zip(PRODUCT_FIELDS, row)) for row in rows]
+
+    @classmethod
+    def stats(cls, query, buckets: int = 10) -> dict:
+        """Returns the aggregate statistics of the Products of a query in one pass
+
+        The matching rows are read once into a CTE that feeds both the totals
+        and a price histogram of equal width integer buckets
+
+        :param query: the Product query to summarize (see find_by_filters)
+        :param buckets: the number of buckets of the price histogram
+        :type buckets: int
+        :return: the count, on-shelf count and ratio, price min, max and
+                 average, and the price histogram
+        :rtype: dict
+        """
+        logger.info("Processing statistics with %s price buckets ...", buckets)
+        filtered = query.order_by(None).with_entities(cls.price, cls.is_on_shelf).cte("filtered")
+        price = filtered.c.price
+        totals = select(
+            func.count().label("count"),
+            func.count().filter(filtered.c.is_on_shelf).label("on_shelf"),
+            func.min(price).label("price_min"),
+            func.max(price).label("price_max"),
+            func.avg(price).label("price_avg"),
+            cast(func.div(func.max(price) - func.min(price) + buckets, buckets), Integer).label("width"),
+        ).cte("totals")
+        bucket = cast(func.div(price - totals.c.price_min, totals.c.width), Integer).label("bucket")
+        histogram = select(bucket, func.count().label("count")).select_from(
+            filtered.join(totals, true())).group_by(bucket).subquery("histogram")
+        counts = select(func.json_agg(func.json_build_array(histogram.c.bucket, histogram.c.count)))
+        row = db.session.execute(select(totals, counts.scalar_subquery().label("histogram"))).one()
+        counts = dict(row.histogram or [])
+        return {
+            "count": row.count,
+            "on_shelf": row.on_shelf,
+            "on_shelf_ratio": row.on_shelf / row.count if row.count else None,
+            "price": {
+                "min": row.price_min,
+                "max": row.price_max,
+                "avg": None if row.price_avg is None else float(row.price_avg),
+            },
+            "histogram": [
+                {"min": low, "max": low + row.width - 1, "count": counts.get(index, 0)}
+                for index, low in enumerate(range(row.price_min, row.price_max + 1, row.width))
+            ] if row.count else [],
+        }
+
+    @classmethod
+    def stream(cls, query, batch_size: int):
+        """Iterates over the Products of a query through a server-side cursor
+        :param query: the Product query to iterate over
+        :param batch_size: the number of rows fetched per round trip
+        :type batch_size: int
+        :return: an iterator that only holds one batch of Products at a time
+        """
+        logger.info("Processing stream of products in batches of %s ...", batch_size)
+        return query.yield_per(batch_size)
+
+    @classmethod
+    def paginate(cls, query, limit: int, after: list = None, sort: str = "id",
+                 descending: bool = False, rank=None) -> tuple:
+        """Returns one page of Products using keyset pagination
+        :param query: the Product query to page through
+        :param limit: the maximum number of Products on the page
+        :type limit: int
+        :param after: the sort key values of the last row of the previous page
+        :type after: list
+        :param sort: the column the page is ordered by (ties broken by id)
+        :type sort: str
+        :param descending: page through the Products in descending order
+        :type descending: bool
+        :param rank: the relevance of a full-text search (see search_rank),
+                     to page through the matches most relevant first (ties
+                     by lowest id) instead of by sort; the rows of the page
+                     get a "rank" column
+        :return: the Products of the page and the sort key values of its
+                 last row, or None when there is no next page
+        :rtype: tuple
+        """
+        if rank is not None:
+            return cls._paginate_by_rank(query, limit, after, rank)
+        logger.info("Processing page of %s products sorted by %s ...", limit, sort)
+        order = cls.sort_order(sort, descending)
+        keys = [cls.id] if sort == "id" else [getattr(cls, sort), cls.id]
+        if after:
+            if len(after) != len(keys) or not all(map(cls._fits_column, keys, after)):
+                raise DataValidationError("Invalid cursor for sort order: " + sort)
+            if descending:
+                query = query.filter(tuple_(*keys) < tuple_(*after))
+            else:
+                query = query.filter(tuple_(*keys) > tuple_(*after))
+        # fetch one extra row to find out whether there is a next page
+        products = query.order_by(None).order_by(*order).limit(limit + 1).all()
+        if len(products) <= limit:
+            return products, None
+        products = products[:limit]
+        return products, [getattr(products[-1], column.key) for column in keys]
+
+    @staticmethod
+    def _fits_column(key, value) -> bool:
+        """Tells whether a cursor value can be compared with the column of its sort key"""
+        if isinstance(key.type, db.Integer):
+            return (isinstance(value, int) and not isinstance(value, bool)
+                    and constant.INTEGER_MIN <= value <= constant.INTEGER_MAX)
+        return isinstance(value, str)
+
+    @classmethod
+    def _paginate_by_rank(cls, query, limit: int, after: list, rank) -> tuple:
+        """Returns one page of the matches of a full-text search, most relevant first"""
+        logger.info("Processing page of %s products ranked by relevance ...", limit)
+        query = query.add_columns(rank.label("rank"))
+        if after:
+            if (len(after) != 2 or isinstance(after[0], bool) or not isinstance(after[0], (int, float))
+                    or not cls._fits_column(cls.id, after[1])):
+                raise DataValidationError("Invalid cursor for a full-text search")
+            # ts_rank is a REAL: compare in single precision, as it was read
+            last_rank = cast(after[0], REAL)
+            # the rank descends while the id ascends, so no row value comparison
+            query = query.filter(or_(rank < last_rank, and_(rank == last_rank, cls.id > after[1])))
+        products = query.order_by(None).order_by(rank.desc(), cls.id).limit(limit + 1).all()
+        if len(products) <= limit:
+            return products, None
+        products = products[:limit]
+        return products, [products[-1].rank, products[-1].id]
@@ -4,15 +4,66 @@ My Service
 Describe what your service does here
 """
 import secrets
-from flask import jsonify, request, url_for, abort
+import hashlib
+import json
+from flask import jsonify, request, url_for, abort, make_response, Response, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse, inputs
+from werkzeug.http import quote_etag
 from service.models import DataValidationError, DatabaseConnectionError
 from service.common import error_handlers, status    # HTTP Status Codes
 from .common import status  # HTTP Status Codes
-from service.models import Product
+from service.models import Product, SORT_KEYS
+from service.common.pagination import encode_cursor, decode_cursor
+from service.common.like_buffer import LikeBuffer
+from service.common.query_log import QueryLog
+from service.common.profiling import Profiler
+from service.common.events import ProductEvents
+from service.common.leaderboard import Leaderboard
+from service.common.admission import AdmissionControl
+from service.common import serializers, pool_metrics, metrics, bulk, single_flight
 
 from . import app, api
 
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_NDJSON = "application/x-ndjson"
+CONTENT_TYPE_CSV = "text/csv"
+CONTENT_TYPE_EVENT_STREAM = "text/event-stream"
+
+# Write-behind buffer for like/unlike actions (see LIKE_BUFFER_* settings)
+like_buffer = LikeBuffer(Product.apply_like_deltas)
+like_buffer.init_app(app)
+
+# Per-request SQL accounting and slow query log, wired up by init_db()
+query_log = QueryLog()
+
+# On-demand and sampled request profiling (see PROFILING_* settings)
+profiler = Profiler()
+profiler.init_app(app)
+
+# Live Product changes for Server-Sent Events clients (see EVENTS_* settings)
+product_events = ProductEvents()
+product_events.init_app(app)
+Product.events = product_events
+
+# In-memory top of the most liked Products, kept up to date by the events
+# of every worker (see TOP_* settings)
+leaderboard = Leaderboard(Product.top_liked)
+leaderboard.init_app(app)
+product_events.add_listener(leaderboard.apply)
+
+# Concurrent identical listings, lookups and statistics share one query
+list_flights = single_flight.SingleFlight("products")
+stats_flights = single_flight.SingleFlight("stats")
+
+# Prometheus request and query telemetry, scraped from /metrics
+metrics.init_app(app)
+
+# Adaptive per-class concurrency limits that shed load before it reaches
+# the database (see ADMISSION_* settings)
+admission = AdmissionControl(bulk=("ProductBatch", "ProductImport", "ProductExport"),
+                             reads=("ProductLookup",), exempt=("ProductStream",))
+admission.init_app(app)
+
 
 ######################################################################
 # Configure the Root route before OpenAPI
@@ -46,7 +97,83 @@ product_model = api.inherit(
     }
 )
 
+batch_result_model = api.model('BatchResult', {
+    'status': fields.Integer(description='The HTTP status of the item'),
+    'id': fields.String(description='The id assigned to the created Product'),
+    'error': fields.String(description='Why the item was rejected'),
+})
+
+batch_model = api.model('BatchResponse', {
+    'created': fields.Integer(description='The number of Products created'),
+    'failed': fields.Integer(description='The number of items rejected'),
+    'results': fields.List(fields.Nested(batch_result_model, skip_none=True),
+                           description='One result per item, in request order'),
+})
+
+lookup_model = api.model('Lookup', {
+    'ids': fields.List(fields.Integer, required=True,
+                       description='The ids of the Products to return, in order'),
+})
+
+lookup_result_model = api.model('LookupResult', {
+    'products': fields.List(fields.Nested(product_model),
+                            description='The Products found, in the order of the ids'),
+    'missing': fields.List(fields.String, description='The ids that were not found'),
+})
+
+change_model = api.inherit(
+    'Change',
+    product_model,
+    {
+        'deleted': fields.Boolean(description='Whether the Product was deleted'),
+        'change_seq': fields.Integer(description='The sequence number of the change'),
+        'updated_at': fields.DateTime(description='When the Product was changed or deleted'),
+    }
+)
+
+changes_model = api.model('Changes', {
+    'changes': fields.List(fields.Nested(change_model, skip_none=True),
+                           description='The changes, oldest first'),
+    'next': fields.String(description='The cursor to pass as since to get the next changes'),
+    'more': fields.Boolean(description='Whether more changes are ready'),
+})
+
+histogram_bucket_model = api.model('PriceBucket', {
+    'min': fields.Integer(description='The lowest price of the bucket'),
+    'max': fields.Integer(description='The highest price of the bucket'),
+    'count': fields.Integer(description='The number of Products priced in the bucket'),
+})
+
+price_stats_model = api.model('PriceStats', {
+    'min': fields.Integer(description='The lowest price'),
+    'max': fields.Integer(description='The highest price'),
+    'avg': fields.Float(description='The average price'),
+})
+
+stats_model = api.model('ProductStats', {
+    'count': fields.Integer(description='The number of matching Products'),
+    'on_shelf': fields.Integer(description='The number of matching Products on shelf'),
+    'on_shelf_ratio': fields.Float(description='The share of matching Products on shelf'),
+    'price': fields.Nested(price_stats_model),
+    'histogram': fields.List(fields.Nested(histogram_bucket_model),
+                             description='The number of Products per price range'),
+})
+
+import_error_model = api.model('ImportError', {
+    'line': fields.Integer(description='The line of the rejected item'),
+    'error': fields.String(description='Why the item was rejected'),
+})
+
+import_model = api.model('ImportResponse', {
+    'imported': fields.Integer(description='The number of Products created or updated'),
+    'failed': fields.Integer(description='The number of items rejected'),
+    'errors': fields.List(fields.Nested(import_error_model),
+                          description='The first items rejected'),
+})
+
 # query string arguments
+FILTER_ARGS = ('name', 'price_min', 'price_max', 'description', 'q',
+               'is_on_shelf', 'like_min', 'like_max')
 product_args = reqparse.RequestParser()
 product_args.add_argument('name', type=str, required=False, location='args',
                           help='Find the Product by name')
@@ -54,6 +181,69 @@ product_args.add_argument('description', type=str, required=False, location='arg
                           help='List Products contains specified description')
 product_args.add_argument('price', type=int, required=False, location='args',
                           help='List Products which has a price less than or equal to input')
+product_args.add_argument('price_min', type=int, required=False, location='args',
+                          help='List Products which has a price greater than or equal to input')
+product_args.add_argument('price_max', type=int, required=False, location='args',
+                          help='List Products which has a price less than or equal to input')
+product_args.add_argument('is_on_shelf', type=inputs.boolean, required=False, location='args',
+                          help='List Products which are (or are not) on shelf')
+product_args.add_argument('like_min', type=int, required=False, location='args',
+                          help='List Products with at least this many likes')
+product_args.add_argument('like_max', type=int, required=False, location='args',
+                          help='List Products with at most this many likes')
+product_args.add_argument('sort', type=str, required=False, location='args', choices=SORT_KEYS,
+                          help='Sort the Products by this field (ties broken by id)')
+product_args.add_argument('order', type=str, required=False, location='args',
+                          choices=('asc', 'desc'), default='asc',
+                          help='Sort the Products in ascending or descending order')
+product_args.add_argument('q', type=str, required=False, location='args',
+                          help='Search Products by name and description, best matches first')
+product_args.add_argument('limit', type=inputs.positive, required=False, location='args',
+                          help='Maximum number of Products to return per page')
+product_args.add_argument('cursor', type=str, required=False, location='args',
+                          help='Opaque cursor of the next page returned by a previous request')
+product_args.add_argument('stream', type=inputs.boolean, required=False, location='args',
+                          help='Stream the Products as a chunked JSON array')
+product_args.add_argument('ids', type=serializers.parse_ids, required=False, location='args',
+                          help='Comma separated ids of the Products to return, in order ({error_msg})')
+product_args.add_argument('fields', type=serializers.parse_fields, required=False, location='args',
+                          help='Comma separated fields to return, e.g. id,price ({error_msg})')
+
+fields_args = reqparse.RequestParser()
+fields_args.add_argument('fields', type=serializers.parse_fields, required=False, location='args',
+                         help='Comma separated fields to return, e.g. id,price ({error_msg})')
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=str, required=False, location='args',
+                          help='The next cursor of the previous response (omit it to start over)')
+changes_args.add_argument('limit', type=inputs.positive, required=False, location='args',
+                          help='Maximum number of changes to return')
+
+stats_args = product_args.copy()
+for argument in ('sort', 'order', 'limit', 'cursor', 'stream', 'ids', 'fields'):
+    stats_args.remove_argument(argument)
+stats_args.add_argument('buckets', type=inputs.int_range(1, app.config['STATS_BUCKETS_MAX']),
+                        required=False, location='args', default=10,
+                        help='Number of buckets of the price histogram')
+
+export_args = reqparse.RequestParser()
+export_args.add_argument('format', type=str, required=False, location='args', choices=bulk.FORMATS,
+                         help='Export as NDJSON or CSV (chosen from the Accept header by default)')
+
+top_args = reqparse.RequestParser()
+top_args.add_argument('by', type=str, required=False, location='args', choices=('like_num',),
+                      default='like_num', help='Rank the Products by this field')
+top_args.add_argument('n', type=inputs.int_range(1, app.config['TOP_MAX_N']), required=False,
+                      location='args', default=10, help='Number of Products to return')
+
+stream_args = reqparse.RequestParser()
+stream_args.add_argument('ids', type=serializers.parse_ids, required=False, location='args',
+                         help='Comma separated ids of the Products to follow (all by default) ({error_msg})')
+
+import_args = reqparse.RequestParser()
+import_args.add_argument('mode', type=str, required=False, location='args', choices=bulk.MODES,
+                         default='upsert',
+                         help='upsert the items by id, or replace the whole catalog with them')
 
 ######################################################################
 # GET HEALTH CHECK
@@ -62,10 +252,44 @@ product_args.add_argument('price', type=int, required=False, location='args',
 
 @app.route("/health")
 def healthcheck():
-    """Let them know our heart is still beating"""
+    """Let them know our heart is still beating, or that we are shedding load"""
+    if admission.overloaded():
+        return (jsonify(status=503, message="Overloaded", budgets=admission.stats()),
+                status.HTTP_503_SERVICE_UNAVAILABLE)
     return jsonify(status=200, message="Healthy"), status.HTTP_200_OK
 
 
+@app.route("/metrics")
+def prometheus_metrics():
+    """Expose the request and database metrics of every worker to Prometheus"""
+    body, content_type = metrics.render()
+    return Response(body, status.HTTP_200_OK, content_type=content_type)
+
+
+@app.route("/health/cache")
+def cache_stats():
+    """Report the hit, miss and eviction counters of the Product cache"""
+    return jsonify(Product.cache.stats()), status.HTTP_200_OK
+
+
+@app.route("/health/single-flight")
+def single_flight_stats():
+    """Report the reads executed and shared by the single-flight groups"""
+    return jsonify(single_flight.stats()), status.HTTP_200_OK
+
+
+@app.route("/health/admission")
+def admission_stats():
+    """Report the limits, requests in flight and shed requests of the admission budgets"""
+    return jsonify(admission.stats()), status.HTTP_200_OK
+
+
+@app.route("/health/pool")
+def pool_stats():
+    """Report the checkouts, wait time and overflow of the database connection pool"""
+    return jsonify(pool_metrics.metrics.stats()), status.HTTP_200_OK
+
+
 ######################################################################
 # Authorization Decorator
 ######################################################################
@@ -110,20 +334,27 @@ class ProductResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_product')
     @api.response(404, 'product not found')
-    @api.marshal_with(product_model)
+    @api.response(304, 'Product not modified')
+    @api.response(200, 'Success', product_model)
     def get(self, product_id):
         """
         Retrieve a single Product
 
-        This endpoint will return a Product based on it's id
+        This endpoint will return a Product based on it's id.
+        Send the ETag of a previous response in `If-None-Match` to get
+        a 304 Not Modified when the Product has not changed, and in the
+        `If-Match` of a PUT to update it only if it has not changed.
+        Use `fields` to return only some fields, e.g. `?fields=id,price`
         """
         app.logger.info(
             "Request to Retrieve a product with id [%s]", product_id)
-        product = Product.find(product_id)
+        args = fields_args.parse_args()
+        product = Product.lookup(product_id, args['fields'])
         if not product:
             abort(status.HTTP_404_NOT_FOUND,
                   "Product with id '{}' was not found.".format(product_id))
-        return product.serialize(), status.HTTP_200_OK
+        etag = version_etag(product.pop('version'), args['fields'])
+        return conditional_response(serializers.shape_product(product), etag=etag)
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PRODUCT
@@ -131,25 +362,37 @@ class ProductResource(Resource):
     @api.doc('update_product')
     @api.response(404, 'Product not found')
     @api.response(400, 'The posted Product data was not valid')
+    @api.response(412, 'The Product changed since the version in If-Match')
+    @api.response(428, 'The request must be sent with If-Match')
     @api.expect(create_model)
     @api.marshal_with(product_model)
     def put(self, product_id):
         """
         Update a Product
 
-        This endpoint will update a Product based the body that is posted
+        This endpoint will update a Product based the body that is posted.
+        Send the ETag of the Product in `If-Match` to update it only if it
+        has not changed since: 412 Precondition Failed means that someone
+        else updated it first.
         """
         app.logger.info('Request to Update a product with id [%s]', product_id)
-        product = Product.find(product_id)
-        if not product:
+        app.logger.debug('Payload = %s', api.payload)
+        versions = if_match_versions()
+        try:
+            product_id = int(product_id)
+        except ValueError:
             abort(status.HTTP_404_NOT_FOUND,
                   "Product with id '{}' was not found.".format(product_id))
-        app.logger.debug('Payload = %s', api.payload)
-        data = api.payload
-        product.deserialize(data)
-        product.id = product_id
-        product.update()
-        return product.serialize(), status.HTTP_200_OK
+        product = Product.replace(product_id, api.payload, versions)
+        if not product:
+            if Product.current_version(product_id) is None:
+                abort(status.HTTP_404_NOT_FOUND,
+                      "Product with id '{}' was not found.".format(product_id))
+            abort(status.HTTP_412_PRECONDITION_FAILED,
+                  "Product with id '{}' was changed since the version in If-Match.".format(product_id))
+        version = product.pop('version')
+        apply_change(product)
+        return product, status.HTTP_200_OK, {'ETag': quote_etag(version_etag(version))}
 
     # ------------------------------------------------------------------
     # DELETE A PRODUCT
@@ -165,7 +408,9 @@ class ProductResource(Resource):
         app.logger.info('Request to Delete a product with id [%s]', product_id)
         product = Product.find(product_id)
         if product:
+            deleted_id = product.id
             product.delete()
+            apply_change({'id': deleted_id}, deleted=True)
             app.logger.info('Product with id [%s] was deleted', product_id)
 
         return '', status.HTTP_204_NO_CONTENT
@@ -183,31 +428,72 @@ class ProductCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_products')
     @api.expect(product_args, validate=True)
-    @api.marshal_list_with(product_model)
+    @api.response(304, 'Products not modified')
+    @api.response(200, 'Success', [product_model])
     def get(self):
         """
         Return all of the Products
+
+        Every filter given is applied in the same query, e.g.
+        `?is_on_shelf=true&price_max=100&sort=like_num&order=desc`.
+        Pass `limit` to receive one page at a time; the `Link` and
+        `X-Next-Cursor` headers point to the next page when there is one.
+        Send `Accept: application/x-ndjson` or `stream=true` to have the
+        Products streamed from a server-side cursor as they are read.
+        Use `fields` to select only some fields, e.g. `?fields=id,price`.
+        Pass `ids=1,2,3` to get those Products in that order; the ids
+        that do not exist are listed in the `X-Missing-Ids` header
         """
         app.logger.info("Request for product list")
-        products = []
         args = product_args.parse_args()
-        if args['name']:
-            app.logger.info('Filtering by name: %s', args['name'])
-            products = Product.find_by_name(args['name'])
-        elif args['price']:
-            app.logger.info('Filtering by price: %s', args['price'])
-            products = Product.find_by_price(args['price'])
-        elif args['description']:
-            app.logger.info('Filtering by description: %s',
-                            args['description'])
-            products = Product.find_by_description(args['description'])
-        else:
-            app.logger.info('Returning unfiltered list.')
-            products = Product.all()
-
-        results = [product.serialize() for product in products]
+        if args['ids'] is not None:
+            products, missing = list_flights.do(flight_key(args), find_many, args['ids'], args['fields'])
+            headers = {'X-Missing-Ids': ','.join(map(str, missing))} if missing else {}
+            return conditional_response(products, headers)
+        descending = args['order'] == 'desc'
+        filters = collection_filters(args)
+        products = Product.find_by_filters(sort=args['sort'], descending=descending, **filters)
+        # searches without a sort key are paged through by relevance
+        rank = Product.search_rank(filters['q']) if filters['q'] and not args['sort'] else None
+        # select only the requested fields, plus the keys a page cursor needs
+        output = args['fields'] or serializers.PRODUCT_FIELDS
+        selected = output
+        limit = after = None
+        if args['limit'] or args['cursor']:
+            keys = (args['sort'] or 'id', 'id')
+            selected = output + tuple(key for key in dict.fromkeys(keys) if key not in output)
+            limit = min(args['limit'] or app.config['PAGE_SIZE_DEFAULT'],
+                        app.config['PAGE_SIZE_MAX'])
+            after = decode_cursor(args['cursor']) if args['cursor'] else None
+        products = products.with_entities(*Product.columns(selected))
+
+        ndjson = request.accept_mimetypes.best_match(
+            [CONTENT_TYPE_JSON, CONTENT_TYPE_NDJSON]) == CONTENT_TYPE_NDJSON
+        if ndjson or args['stream']:
+            app.logger.info("Streaming products")
+            headers = {}
+            if limit:
+                products, last = Product.paginate(products, limit, after,
+                                                  args['sort'] or 'id', descending, rank)
+                if last:
+                    headers = next_page_headers(encode_cursor(last), limit)
+            else:
+                products = Product.stream(products, app.config['STREAM_BATCH_SIZE'])
+            return Response(stream_with_context(generate_products(products, ndjson,
+                                                                  selected, output)),
+                            mimetype=CONTENT_TYPE_NDJSON if ndjson else CONTENT_TYPE_JSON,
+                            headers=headers)
+
+        # revalidated against the newest change of the catalog, before any row is read
+        etag = catalog_etag()
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        # a listing read before this ETag was taken must not be sent with it
+        results, last = list_flights.do((flight_key(args), etag), read_products, products, limit, after,
+                                        args['sort'] or 'id', descending, selected, output, rank)
+        headers = next_page_headers(encode_cursor(last), limit) if last else {}
         app.logger.info("Returning %d products", len(results))
-        return results, status.HTTP_200_OK
+        return conditional_response(results, headers, etag)
 
     # ------------------------------------------------------------------
     # ADD A NEW PRODUCT
@@ -226,10 +512,289 @@ class ProductCollection(Resource):
         app.logger.debug('Payload = %s', api.payload)
         product.deserialize(api.payload)
         product.create()
+        data = product.serialize()
+        apply_change(data)
         app.logger.info("Product with ID [%s] created.", product.id)
         location_url = api.url_for(
             ProductResource, product_id=product.id, _external=True)
-        return product.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        headers = {"Location": location_url, "ETag": quote_etag(version_etag(product.version))}
+        return data, status.HTTP_201_CREATED, headers
+
+
+######################################################################
+#  PATH: /products:batch
+######################################################################
+@api.route('/products:batch')
+class ProductBatch(Resource):
+    """ Handles bulk creation of Products """
+    # ------------------------------------------------------------------
+    # ADD MANY NEW PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('create_products')
+    @api.response(400, 'The posted data was not a list of Products')
+    @api.response(413, 'Too many Products in one batch')
+    @api.response(415, 'Unsupported media type')
+    @api.expect([create_model])
+    @api.marshal_with(batch_model)
+    def post(self):
+        """
+        Creates many Products
+        This endpoint will create every valid Product of a JSON array or
+        NDJSON body in one transaction and report the id or error of each item
+        """
+        app.logger.info("Request to create a batch of products")
+        items = batch_payload()
+        if not items:
+            raise DataValidationError("Invalid batch: no Products were posted")
+        if len(items) > app.config['BATCH_SIZE_MAX']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  'A batch holds at most {} Products.'.format(app.config['BATCH_SIZE_MAX']))
+
+        products, results = [], []
+        for item in items:
+            try:
+                product = Product().deserialize(item)
+                # an item that does not fit the columns would fail the INSERT of the whole batch
+                _, _, product.price, product.like_num, _ = bulk.check_columns(product)
+                products.append(product)
+                results.append({'status': status.HTTP_201_CREATED})
+            except DataValidationError as error:
+                results.append({'status': status.HTTP_400_BAD_REQUEST, 'error': str(error)})
+
+        ids = iter(Product.create_many(products, app.config['BATCH_CHUNK_SIZE']))
+        forget_reads()
+        leaderboard.clear()
+        for result in results:
+            if result['status'] == status.HTTP_201_CREATED:
+                result['id'] = next(ids)
+        app.logger.info("Created %d products, rejected %d",
+                        len(products), len(results) - len(products))
+        return {
+            'created': len(products),
+            'failed': len(results) - len(products),
+            'results': results
+        }, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/changes
+######################################################################
+@api.route('/products/changes')
+class ProductChanges(Resource):
+    """ Handles the change feed of the catalog """
+    # ------------------------------------------------------------------
+    # LIST THE CHANGES SINCE A CURSOR
+    # ------------------------------------------------------------------
+    @api.doc('list_product_changes')
+    @api.expect(changes_args)
+    @api.response(400, 'The cursor was not valid')
+    @api.response(200, 'Success', changes_model)
+    def get(self):
+        """
+        Returns the Products changed or deleted since a cursor
+
+        Start without `since` to receive every Product, then pass the `next`
+        cursor of each response to receive only what changed in between.
+        Deleted Products come back as `{"id": ..., "deleted": true}`.
+        When `more` is true the next changes are ready right away
+        """
+        args = changes_args.parse_args()
+        after = decode_cursor(args['since']) if args['since'] and args['since'] != '0' else None
+        limit = min(args['limit'] or app.config['PAGE_SIZE_DEFAULT'], app.config['PAGE_SIZE_MAX'])
+        changes, cursor, more = Product.changes(after, limit)
+        app.logger.info("Returning %d changes", len(changes))
+        return conditional_response({
+            'changes': [serializers.shape_product(change) for change in changes],
+            'next': encode_cursor(cursor),
+            'more': more,
+        })
+
+
+######################################################################
+#  PATH: /products/stats
+######################################################################
+@api.route('/products/stats')
+class ProductStats(Resource):
+    """ Handles statistics of collections of Products """
+    # ------------------------------------------------------------------
+    # SUMMARIZE PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('product_stats')
+    @api.expect(stats_args, validate=True)
+    @api.response(304, 'Statistics not modified')
+    @api.response(200, 'Success', stats_model)
+    def get(self):
+        """
+        Summarizes the Products
+
+        This endpoint will count the Products matching the filters of the
+        product list (on shelf too) and compute their lowest, highest and
+        average price and a histogram of `buckets` price ranges, in one
+        query. The results are cached for a few seconds
+        """
+        app.logger.info("Request for product statistics")
+        args = stats_args.parse_args()
+        filters = collection_filters(args)
+        key = serializers.dumps({'filters': filters, 'buckets': args['buckets']}).decode('utf-8')
+        stats = Product.stats_cache.get(key)
+        if stats is None:
+            stats = stats_flights.do(key, product_stats, filters, args['buckets'], key)
+        return conditional_response(stats)
+
+
+######################################################################
+#  PATH: /products/top
+######################################################################
+@api.route('/products/top')
+class ProductTop(Resource):
+    """ Handles the leaderboard of the most liked Products """
+    # ------------------------------------------------------------------
+    # LIST THE MOST LIKED PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('top_products')
+    @api.expect(top_args, validate=True)
+    @api.response(304, 'Products not modified')
+    @api.response(200, 'Success', [product_model])
+    def get(self):
+        """
+        Returns the most liked Products
+
+        This endpoint will return the `n` Products on shelf with the most
+        likes, ties broken by id, from a leaderboard each worker keeps in
+        memory and updates with the likes and shelf changes of every worker
+        """
+        args = top_args.parse_args()
+        product_events.start()
+        products = leaderboard.top(args['n'])
+        return conditional_response([serializers.shape_product(product) for product in products])
+
+
+######################################################################
+#  PATH: /products/stream
+######################################################################
+@api.route('/products/stream')
+class ProductStream(Resource):
+    """ Handles live streams of Product changes """
+    # ------------------------------------------------------------------
+    # FOLLOW THE CHANGES OF PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('stream_products')
+    @api.expect(stream_args)
+    @api.response(200, 'Server-Sent Events of the changed Products')
+    def get(self):
+        """
+        Streams Product changes
+        This endpoint will push a Server-Sent Event with the Product (or its
+        id and `deleted`) every time one is created, updated, liked or deleted.
+        Use `ids` to follow only some Products. A `resync` event ends the
+        stream when events were lost: catch up with /products/changes
+        """
+        args = stream_args.parse_args()
+        app.logger.info("Request to stream product changes")
+        subscription = product_events.subscribe(args['ids'])
+        response = Response(product_events.stream(subscription), mimetype=CONTENT_TYPE_EVENT_STREAM,
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(lambda: product_events.unsubscribe(subscription))
+        return response
+
+
+######################################################################
+#  PATH: /products/export
+######################################################################
+@api.route('/products/export')
+class ProductExport(Resource):
+    """ Handles exports of the whole catalog """
+    # ------------------------------------------------------------------
+    # EXPORT ALL PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('export_products')
+    @api.expect(export_args)
+    @api.response(200, 'The Products as NDJSON or CSV')
+    def get(self):
+        """
+        Exports every Product
+        This endpoint will stream the whole catalog, ordered by id, as NDJSON
+        or CSV straight from a PostgreSQL COPY
+        """
+        app.logger.info("Request to export the products")
+        args = export_args.parse_args()
+        fmt = args['format']
+        if fmt is None:
+            best = request.accept_mimetypes.best_match([CONTENT_TYPE_NDJSON, CONTENT_TYPE_CSV])
+            fmt = 'csv' if best == CONTENT_TYPE_CSV else 'ndjson'
+        return Response(stream_with_context(bulk.export_products(fmt)),
+                        mimetype=CONTENT_TYPE_CSV if fmt == 'csv' else CONTENT_TYPE_NDJSON,
+                        headers={'Content-Disposition': f'attachment; filename=products.{fmt}'})
+
+
+######################################################################
+#  PATH: /products/import
+######################################################################
+@api.route('/products/import')
+class ProductImport(Resource):
+    """ Handles imports of many Products """
+    # ------------------------------------------------------------------
+    # IMPORT MANY PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('import_products')
+    @api.expect(import_args)
+    @api.response(400, 'An item was not valid in replace mode')
+    @api.response(415, 'Unsupported media type')
+    @api.marshal_with(import_model)
+    def post(self):
+        """
+        Imports Products
+        This endpoint will read an NDJSON or CSV body as it is uploaded and
+        load it through a PostgreSQL COPY in one transaction. Items with an
+        id are upserted; `mode=replace` swaps the whole catalog instead
+        """
+        app.logger.info("Request to import products")
+        args = import_args.parse_args()
+        formats = {CONTENT_TYPE_NDJSON: 'ndjson', CONTENT_TYPE_CSV: 'csv'}
+        if request.mimetype not in formats:
+            abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                  'Content-Type must be {} or {}'.format(CONTENT_TYPE_NDJSON, CONTENT_TYPE_CSV))
+        result = bulk.import_products(request.stream, formats[request.mimetype], args['mode'])
+        forget_reads()
+        leaderboard.clear()
+        return result, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products:lookup
+######################################################################
+@api.route('/products:lookup')
+class ProductLookup(Resource):
+    """ Handles lookups of many Products by id """
+    # ------------------------------------------------------------------
+    # RETRIEVE MANY PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('lookup_products')
+    @api.expect(lookup_model, fields_args)
+    @api.response(400, 'The posted data was not a list of ids')
+    @api.response(413, 'Too many ids in one lookup')
+    @api.response(415, 'Unsupported media type')
+    @api.response(200, 'Success', lookup_result_model)
+    def post(self):
+        """
+        Retrieves many Products by id
+        This endpoint will return the Products of every posted id in one
+        query, in the order of the ids, and the ids that do not exist
+        """
+        app.logger.info("Request to look up a batch of products")
+        if request.mimetype != CONTENT_TYPE_JSON:
+            abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                  'Content-Type must be {}'.format(CONTENT_TYPE_JSON))
+        body = request.get_json()
+        try:
+            ids = serializers.parse_ids(body.get('ids') if isinstance(body, dict) else None)
+        except ValueError as error:
+            raise DataValidationError(str(error)) from error
+        args = fields_args.parse_args()
+        products, missing = find_many(ids, args['fields'])
+        # a POST is not cached, so no ETag: the body is sent as is
+        return {'products': products, 'missing': missing}, status.HTTP_200_OK
+
 
 # ######################################################################
 # # ACTIONS ON PRODUCT
@@ -248,17 +813,13 @@ class LikeProduct(Resource):
         This endpoint will increase the like_num of the Product
         """
         app.logger.info('Request to like a Product')
-        product = Product.find(product_id)
+        product = like_product(product_id, 1)
         if not product:
             abort(status.HTTP_404_NOT_FOUND,
                   'Product with id [{}] was not found.'.format(product_id))
 
-        product.id = product_id
-        product.like_num += 1
-        product.update()
-
-        app.logger.info('Product with id [%s] has been liked!', product.id)
-        return product.serialize(), status.HTTP_200_OK
+        app.logger.info('Product with id [%s] has been liked!', product_id)
+        return product, status.HTTP_200_OK
 
 
 @api.route('/products/<product_id>/unlike')
@@ -273,17 +834,13 @@ class UnlikeProduct(Resource):
         This endpoint will decrease the like_num of the Product
         """
         app.logger.info('Request to unlike a Product')
-        product = Product.find(product_id)
+        product = like_product(product_id, -1)
         if not product:
             abort(status.HTTP_404_NOT_FOUND,
                   'Product with id [{}] was not found.'.format(product_id))
 
-        product.id = product_id
-        product.like_num -= 1
-        product.update()
-
-        app.logger.info('Product with id [%s] decrease one like', product.id)
-        return product.serialize(), status.HTTP_200_OK
+        app.logger.info('Product with id [%s] decrease one like', product_id)
+        return product, status.HTTP_200_OK
 
 
 @api.route('/products/<product_id>/on-shelf')
@@ -306,10 +863,11 @@ class OnshelfProduct(Resource):
                   'Product with id [{}] was not found.'.format(product_id))
 
         product.is_on_shelf = True
-        product.update()
+        data = product.update()
+        apply_change(data)
 
-        app.logger.info('Product with id [%s] is now onshelf', product.id)
-        return product.serialize(), status.HTTP_200_OK
+        app.logger.info('Product with id [%s] is now onshelf', product_id)
+        return data, status.HTTP_200_OK
 
 
 @api.route('/products/<product_id>/off-shelf')
@@ -332,10 +890,11 @@ class OffshelfProduct(Resource):
                   'Product with id [{}] was not found.'.format(product_id))
 
         product.is_on_shelf = False
-        product.update()
+        data = product.update()
+        apply_change(data)
 
-        app.logger.info('Product with id [%s] is now offshelf', product.id)
-        return product.serialize(), status.HTTP_200_OK
+        app.logger.info('Product with id [%s] is now offshelf', product_id)
+        return data, status.HTTP_200_OK
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
@@ -347,7 +906,199 @@ class OffshelfProduct(Resource):
 #     api.abort(error_code, message)
 
 
+def forget_reads():
+    """Lets the listings and statistics read after a write see it"""
+    list_flights.forget_all()
+    stats_flights.forget_all()
+
+
+def apply_change(product: dict, deleted: bool = False):
+    """Takes a written Product into account in this worker at once
+
+    The other workers learn of it from the event the write sent (see Product.notify)
+    """
+    forget_reads()
+    leaderboard.apply(dict(product, deleted=deleted))
+
+
+def collection_filters(args) -> dict:
+    """Reads the filters of Product.find_by_filters from the query string arguments"""
+    filters = {key: args[key] for key in FILTER_ARGS}
+    if filters['price_max'] is None:
+        filters['price_max'] = args['price']
+    app.logger.info('Filtering by %s', {key: value for key, value in filters.items()
+                                        if value is not None})
+    return filters
+
+
+def next_page_headers(cursor: str, limit: int) -> dict:
+    """Builds the headers that point a client to the next page of a listing"""
+    params = request.args.to_dict()
+    params.update(cursor=cursor, limit=limit)
+    next_url = api.url_for(ProductCollection, _external=True, **params)
+    return {"Link": f'<{next_url}>; rel="next"', "X-Next-Cursor": cursor}
+
+
+@api.representation(CONTENT_TYPE_JSON)
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON body encoded by the fast serializer"""
+    resp = make_response(serializers.dumps(data) + b"\n", code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+def conditional_response(data, headers: dict = None, etag: str = None):
+    """Returns 304 Not Modified when the client already has this data,
+    otherwise the data encoded as JSON with its ETag
+
+    :param data: Products already shaped like product_model
+    :param etag: the ETag of the data (a hash of the body by default); when
+                 given, a matching request is answered before data is encoded
+    """
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return not_modified(etag, headers)
+    body = serializers.dumps(data)
+    etag = etag or hashlib.sha1(body).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag, headers)
+    return Response(body, status.HTTP_200_OK, dict(headers or {}, ETag=quote_etag(etag)),
+                    mimetype=CONTENT_TYPE_JSON)
+
+
+def not_modified(etag: str, headers: dict = None) -> Response:
+    """Returns 304 Not Modified with the ETag the client already has"""
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=dict(headers or {}, ETag=quote_etag(etag)))
+
+
+def catalog_etag() -> str:
+    """Returns the ETag of the listings: the version of the whole catalog"""
+    return "c" + Product.catalog_version()
+
+
+def version_etag(version: int, fields=None) -> str:
+    """Returns the ETag of a version of a Product, or of some of its fields"""
+    if fields is None or tuple(fields) == serializers.PRODUCT_FIELDS:
+        return str(version)
+    return f'{version}-{".".join(fields)}'
+
+
+def if_match_versions():
+    """Returns the versions of a Product the If-Match header of the request accepts
+
+    :return: the versions, or None when any version may be overwritten
+             (no If-Match, or If-Match: *)
+    """
+    if not request.if_match:
+        if app.config['PUT_REQUIRE_IF_MATCH']:
+            abort(status.HTTP_428_PRECONDITION_REQUIRED,
+                  'Send the ETag of the Product in If-Match to update it.')
+        return None
+    if request.if_match.star_tag:
+        return None
+    versions = []
+    for etag in request.if_match.as_set():
+        version = etag.split('-')[0]
+        if version.isdigit():
+            versions.append(int(version))
+    return versions
+
+
+def generate_products(rows, ndjson: bool, fields=serializers.PRODUCT_FIELDS, output=None):
+    """Yields Products one at a time as NDJSON lines or as a JSON array"""
+    products = serializers.iter_products(rows, fields, output)
+    if ndjson:
+        for product in products:
+            yield serializers.dumps(product) + b"\n"
+        return
+    yield b"["
+    for count, product in enumerate(products):
+        yield (b"," if count else b"") + serializers.dumps(product)
+    yield b"]"
+
+
+def flight_key(args) -> tuple:
+    """Returns the key of a listing: the parsed arguments it depends on"""
+    return tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                        for name, value in args.items()))
+
+
+def read_products(query, limit: int, after: list, sort: str, descending: bool,
+                  selected: tuple, output: tuple, rank=None) -> tuple:
+    """Reads a listing, or one page of it when limit is set
+
+    :return: the Products shaped like product_model, and the sort key
+             values of the last one when there is a next page
+    :rtype: tuple
+    """
+    last = None
+    if limit:
+        query, last = Product.paginate(query, limit, after, sort, descending, rank)
+    return serializers.rows_to_products(query, selected, output), last
+
+
+def product_stats(filters: dict, buckets: int, key: str) -> dict:
+    """Computes the statistics of the filtered Products and caches them under key"""
+    stats = Product.stats(Product.find_by_filters(**filters), buckets)
+    Product.stats_cache.set(key, stats)
+    return stats
+
+
+def find_many(ids: list, fields=None) -> tuple:
+    """Finds Products by id, shaped like product_model, and the ids not found"""
+    if len(ids) > app.config['LOOKUP_IDS_MAX']:
+        abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+              'A lookup holds at most {} ids.'.format(app.config['LOOKUP_IDS_MAX']))
+    products, missing = Product.find_many(ids, fields or serializers.PRODUCT_FIELDS)
+    app.logger.info("Found %d products, %d missing", len(products), len(missing))
+    return [serializers.shape_product(product) for product in products], [str(id_) for id_ in missing]
+
+
+def like_product(product_id, delta: int) -> dict:
+    """Adds likes to a Product, through the like buffer when it is enabled,
+    and returns it shaped like product_model
+
+    With the buffer the returned like_num is the projected count: the value
+    in the database (read through the cache) plus the likes of this worker
+    that are not flushed yet
+    """
+    if not like_buffer.enabled:
+        data = Product.add_likes(product_id, delta)
+        if not data:
+            return None
+        apply_change(data)
+        return serializers.shape_product(data)
+    data = Product.lookup(product_id)
+    if not data:
+        return None
+    data.pop("version")
+    data["like_num"] = (data["like_num"] or 0) + like_buffer.add(data["id"], delta)
+    # the flush sends one event per Product with every like it buffered
+    return serializers.shape_product(data)
+
+
+def batch_payload() -> list:
+    """Reads the items of a batch from a JSON array or an NDJSON body"""
+    if request.mimetype == CONTENT_TYPE_NDJSON:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(line)  # reported as invalid by deserialize
+        return items
+    if request.mimetype != CONTENT_TYPE_JSON:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+              'Content-Type must be {} or {}'.format(CONTENT_TYPE_JSON, CONTENT_TYPE_NDJSON))
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise DataValidationError("Invalid batch: body of request must be a list of Products")
+    return items
+
+
 def init_db():
     """ Initializes the SQLAlchemy app """
     global app
     Product.init_db(app)
+    query_log.init_app(app)
@@ -0,0 +1,63 @@
+"""
+Admission Control Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+from unittest import TestCase
+from service.common.admission import Budget
+
+
+######################################################################
+#  B U D G E T   T E S T   C A S E S
+######################################################################
+class TestBudget(TestCase):
+    """Test Cases for the adaptive concurrency limits"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.now = 0.0
+        self.budget = Budget("test", 4, target=0.1, backoff=0.5, clock=lambda: self.now)
+
+    def test_reject_when_full(self):
+        """It should admit up to the limit and reject the requests beyond it"""
+        admitted = [self.budget.acquire() for _ in range(4)]
+        self.assertNotIn(None, admitted)
+        self.assertIsNone(self.budget.acquire())
+        self.budget.release(admitted[0])
+        self.assertIsNotNone(self.budget.acquire())
+        stats = self.budget.stats()
+        self.assertEqual(stats["in_flight"], 4)
+        self.assertEqual(stats["admitted"], 5)
+        self.assertEqual(stats["rejected"], 1)
+
+    def test_decrease_once_per_round(self):
+        """It should shrink the limit once for the slow requests admitted together"""
+        admitted = [self.budget.acquire() for _ in range(3)]
+        self.now = 1.0
+        for admitted_at in admitted:
+            self.budget.release(admitted_at, 0.5)
+        self.assertEqual(self.budget.limit, 2.0)
+        self.budget.release(self.budget.acquire(), 0.5)
+        self.assertEqual(self.budget.limit, 1.0)
+        self.budget.release(self.budget.acquire(), 0.5)
+        self.assertEqual(self.budget.limit, 1.0)  # never below one request
+        self.assertIsNotNone(self.budget.acquire())
+        self.assertIsNone(self.budget.acquire())
+
+    def test_increase_additively(self):
+        """It should grow the limit back by about one per round of fast requests"""
+        self.budget.release(self.budget.acquire(), 0.5)
+        self.assertEqual(self.budget.limit, 2.0)
+        self.budget.release(self.budget.acquire(), 0.01)
+        self.assertEqual(self.budget.limit, 2.5)
+        for _ in range(10):
+            self.budget.release(self.budget.acquire(), 0.01)
+        self.assertEqual(self.budget.limit, 4.0)  # never above the configured limit
+
+    def test_no_queries(self):
+        """It should keep the limit for requests that sent no query"""
+        self.budget.release(self.budget.acquire(), 0.5)
+        self.budget.release(self.budget.acquire())
+        self.assertEqual(self.budget.limit, 2.0)
+        self.assertEqual(self.budget.stats()["in_flight"], 0)
@@ -0,0 +1,179 @@
+"""
+Cache Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+from unittest import TestCase
+from service.common.cache import LocalCache, RedisCache, from_config
+
+
+class FakeClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """Local stand-in for the few Redis commands the cache uses"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, px=None):
+        self.data[key] = value.encode("utf-8")
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in self.data if key.startswith(match.rstrip("*"))]
+
+
+class BrokenRedis:
+    """A Redis client whose server is down"""
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            raise ConnectionError("Connection refused")
+        return command
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestLocalCache(TestCase):
+    """Test Cases for the in-process LRU/TTL cache"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.clock = FakeClock()
+        self.cache = LocalCache(max_entries=2, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """It should return cached values and count hits and misses"""
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", {"id": 1})
+        self.assertEqual(self.cache.get("a"), {"id": 1})
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["entries"], 1)
+
+    def test_expire(self):
+        """It should not return values older than the TTL"""
+        self.cache.set("a", 1)
+        self.clock.now = 9.9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_evict_least_recently_used(self):
+        """It should evict the least recently used value when full"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_delete_and_clear(self):
+        """It should invalidate one or all values"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.delete("a")
+        self.cache.delete("missing")
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("b"))
+
+    def test_stale_set(self):
+        """It should not cache a value read before its key was deleted"""
+        generation = self.cache.generation("a")
+        self.cache.delete("a")
+        self.cache.set("a", "stale", generation)
+        self.assertIsNone(self.cache.get("a"))
+        generation = self.cache.generation("a")
+        self.cache.clear()
+        self.cache.set("a", "stale", generation)
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", "fresh", self.cache.generation("a"))
+        self.assertEqual(self.cache.get("a"), "fresh")
+
+    def test_forget_generations(self):
+        """It should keep at most max_entries generations without letting stale values in"""
+        generation = self.cache.generation("a")
+        self.cache.delete("a")
+        for key in ("b", "c"):
+            self.cache.delete(key)
+        self.assertLessEqual(len(self.cache._generations), 2)
+        self.cache.set("a", "stale", generation)
+        self.assertIsNone(self.cache.get("a"))
+
+
+class TestRedisCache(TestCase):
+    """Test Cases for the shared Redis cache"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = FakeRedis()
+        self.cache = RedisCache(client=self.client, ttl=10)
+
+    def test_get_and_set(self):
+        """It should store JSON values under a prefix"""
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", {"id": 1})
+        self.assertIn("products:a", self.client.data)
+        self.assertEqual(self.cache.get("a"), {"id": 1})
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_delete_and_clear(self):
+        """It should invalidate one or all values"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.delete("a")
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.clear()
+        self.assertEqual(self.client.data, {})
+
+    def test_stale_set(self):
+        """It should not serve a value read before its key was deleted"""
+        generation = self.cache.generation("a")
+        self.cache.delete("a")
+        self.cache.set("a", "stale", generation)
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", "fresh", self.cache.generation("a"))
+        self.assertEqual(self.cache.get("a"), "fresh")
+
+    def test_redis_down(self):
+        """It should miss, not fail, when Redis is down"""
+        cache = RedisCache(client=BrokenRedis())
+        cache.set("a", 1, cache.generation("a"))
+        self.assertIsNone(cache.get("a"))
+        cache.delete("a")
+        cache.clear()
+        self.assertEqual(cache.stats()["errors"], 5)
+
+    def test_from_config(self):
+        """It should use the local cache unless a cache URL is configured"""
+        config = {"CACHE_URL": "", "CACHE_TTL": 5, "CACHE_MAX_ENTRIES": 10}
+        cache = from_config(config)
+        self.assertIsInstance(cache, LocalCache)
+        self.assertEqual(cache.max_entries, 10)
+        self.assertEqual(cache.ttl, 5)
+        self.assertEqual(from_config(config, ttl=1).ttl, 1)
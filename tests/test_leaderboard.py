@@ -0,0 +1,98 @@
+"""
+Leaderboard Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+import random
+from unittest import TestCase
+from service.common.leaderboard import Leaderboard, rank
+
+
+######################################################################
+#  L E A D E R B O A R D   T E S T   C A S E S
+######################################################################
+class TestLeaderboard(TestCase):
+    """Test Cases for the in-memory top of the most liked Products"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.now = 0.0
+        self.table = {}
+        self.board = Leaderboard(self.seed, size=4, refresh=60, clock=lambda: self.now)
+
+    def seed(self, limit):
+        """Reads the top of the fake table like Product.top_liked"""
+        return self.expected(limit)
+
+    def expected(self, n):
+        """Returns the top of the fake table by brute force"""
+        products = [dict(product) for product in self.table.values() if product["is_on_shelf"]]
+        return sorted(products, key=rank, reverse=True)[:n]
+
+    def write(self, product_id, like_num, is_on_shelf=True):
+        """Writes a Product to the fake table and to the leaderboard"""
+        product = {"id": product_id, "name": f"p{product_id}", "description": "", "price": 1,
+                   "like_num": like_num, "is_on_shelf": is_on_shelf}
+        self.table[product_id] = product
+        self.board.apply(dict(product))
+
+    def delete(self, product_id):
+        """Deletes a Product from the fake table and the leaderboard"""
+        del self.table[product_id]
+        self.board.apply({"id": product_id, "deleted": True})
+
+    def ids(self, n):
+        """Returns the ids of the top n of the leaderboard"""
+        return [product["id"] for product in self.board.top(n)]
+
+    def test_seed_and_rank(self):
+        """It should seed from the table and rank by likes, then lowest id"""
+        for product_id, like_num in ((1, 5), (2, 9), (3, 5), (4, None), (5, 7)):
+            self.write(product_id, like_num)
+        self.write(6, 50, is_on_shelf=False)
+        self.assertEqual(self.ids(2), [2, 5])
+        self.assertEqual(self.ids(4), [2, 5, 1, 3])
+        self.assertEqual(self.board.seeds, 1)
+
+    def test_updates_without_seeding(self):
+        """It should follow likes, shelf changes and deletes in memory"""
+        for product_id in range(1, 11):
+            self.write(product_id, product_id)
+        self.assertEqual(self.ids(2), [10, 9])
+        self.write(1, 100)            # rises above the floor
+        self.write(9, 9, False)       # taken off shelf
+        self.delete(10)
+        self.assertEqual(self.ids(2), [1, 8])
+        self.assertEqual(self.board.seeds, 1)
+
+    def test_reseed(self):
+        """It should read the table again when too few Products are tracked"""
+        for product_id in range(1, 11):
+            self.write(product_id, product_id)
+        self.board.top(2)
+        for product_id in (10, 9, 8):
+            self.write(product_id, 0)  # drop to the floor and are forgotten
+        self.assertEqual(self.ids(2), [7, 6])
+        self.assertEqual(self.board.seeds, 2)
+        self.board.apply({"id": 1, "deleted": False})  # a truncated event
+        self.board.top(2)
+        self.assertEqual(self.board.seeds, 3)
+        self.now += 60
+        self.board.top(2)
+        self.assertEqual(self.board.seeds, 4)
+
+    def test_random_writes(self):
+        """It should always agree with the table"""
+        generator = random.Random(2820)
+        for product_id in range(1, 30):
+            self.write(product_id, generator.randrange(20))
+        for _ in range(2000):
+            product_id = generator.randrange(1, 40)
+            if product_id in self.table and generator.random() < 0.1:
+                self.delete(product_id)
+            else:
+                self.write(product_id, generator.randrange(20), generator.random() < 0.9)
+            n = generator.randrange(1, 3)
+            self.assertEqual(self.ids(n), [product["id"] for product in self.expected(n)])
+        self.assertLess(self.board.seeds, 1000)
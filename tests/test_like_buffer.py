@@ -0,0 +1,63 @@
+"""
+Like Buffer Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+import threading
+from unittest import TestCase
+from service.common.like_buffer import LikeBuffer
+
+
+######################################################################
+#  L I K E   B U F F E R   T E S T   C A S E S
+######################################################################
+class TestLikeBuffer(TestCase):
+    """Test Cases for the write-behind Like Buffer"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.flushed = []
+        self.buffer = LikeBuffer(self.flushed.append)
+        self.buffer.flush_interval = 60
+
+    def test_add_likes(self):
+        """It should sum the likes of each Product until they are flushed"""
+        self.assertEqual(self.buffer.add(1, 1), 1)
+        self.assertEqual(self.buffer.add(1, 1), 2)
+        self.assertEqual(self.buffer.add(2, -1), -1)
+        self.assertEqual(self.buffer.pending(1), 2)
+        self.assertEqual(self.buffer.pending(3), 0)
+        self.assertEqual(self.flushed, [])
+
+    def test_flush(self):
+        """It should write all pending likes in one batch"""
+        self.buffer.add(1, 1)
+        self.buffer.add(1, 1)
+        self.buffer.add(2, 1)
+        self.buffer.add(2, -1)
+        self.buffer.flush()
+        self.assertEqual(self.flushed, [{1: 2}])
+        self.assertEqual(self.buffer.pending(1), 0)
+        self.buffer.flush()
+        self.assertEqual(len(self.flushed), 1)
+
+    def test_flush_failure(self):
+        """It should keep the likes when they cannot be written"""
+        def fail(deltas):
+            raise ConnectionError("database is down")
+
+        self.buffer.apply = fail
+        self.buffer.add(1, 3)
+        self.buffer.flush()
+        self.assertEqual(self.buffer.pending(1), 3)
+
+    def test_flush_after_max_events(self):
+        """It should flush in the background once enough likes are waiting"""
+        done = threading.Event()
+        self.buffer.apply = lambda deltas: (self.flushed.append(deltas), done.set())
+        self.buffer.max_events = 3
+        for _ in range(3):
+            self.buffer.add(7, 1)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.flushed, [{7: 3}])
@@ -6,14 +6,19 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
+import threading
 from unittest import TestCase
-# from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 
 from urllib.parse import quote_plus
-from service import app
+from sqlalchemy import text
+from service import app, migrations
 from service.models import db, init_db, Product
+from service.routes import like_buffer, leaderboard, list_flights, admission
 from service.common import status  # HTTP Status Codes
+from service.common.pagination import encode_cursor
 from tests.factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -38,6 +43,7 @@ class TestProductServer(TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         init_db(app)
+        migrations.upgrade()
 
     @classmethod
     def tearDownClass(cls):
@@ -49,6 +55,9 @@ class TestProductServer(TestCase):
         self.client = app.test_client()
         db.session.query(Product).delete()  # clean up the last tests
         db.session.commit()
+        Product.cache.clear()
+        Product.stats_cache.clear()
+        leaderboard.clear()
 
     def tearDown(self):
         """ This runs after each test """
@@ -88,6 +97,73 @@ class TestProductServer(TestCase):
         self.assertEqual(data["status"], 200)
         self.assertEqual(data["message"], "Healthy")
 
+    def test_shed_when_budget_full(self):
+        """It should turn requests away with 503 and Retry-After when their budget is full"""
+        product = self._create_products(1)[0]
+        bulk = admission.budgets["bulk"]
+        held = [bulk.acquire() for _ in range(bulk.maximum)]
+        try:
+            response = self.client.get(f"{BASE_URL}/export")
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response.headers["Retry-After"], str(app.config["ADMISSION_RETRY_AFTER"]))
+            self.assertEqual(response.get_json()["error"], "Service Unavailable")
+            # the other budgets still admit their requests
+            self.assertEqual(self.client.get(f"{BASE_URL}/{product.id}").status_code, status.HTTP_200_OK)
+            response = self.client.get("/health")
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response.get_json()["message"], "Overloaded")
+            self.assertEqual(response.get_json()["budgets"]["bulk"]["rejected"], bulk.stats()["rejected"])
+        finally:
+            for admitted_at in held:
+                bulk.release(admitted_at)
+            admission._shed_at = None  # pylint: disable=protected-access
+        self.assertEqual(self.client.get(f"{BASE_URL}/export").status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get("/health").status_code, status.HTTP_200_OK)
+
+    def test_admission_budgets(self):
+        """It should serve each request from the budget of its class"""
+        stats = self.client.get("/health/admission").get_json()
+        product = self._create_products(1)[0]
+        self.client.get(f"{BASE_URL}/{product.id}")
+        self.client.post(f"{BASE_URL}:lookup", json={"ids": [product.id]})
+        self.client.get("/health")
+        response = self.client.get("/health/admission")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["write"]["admitted"] - stats["write"]["admitted"], 1)
+        self.assertEqual(data["read"]["admitted"] - stats["read"]["admitted"], 2)
+        self.assertEqual(data["bulk"]["admitted"], stats["bulk"]["admitted"])
+        for budget in data.values():
+            self.assertEqual(budget["in_flight"], 0)
+
+    def test_pool_stats(self):
+        """It should report the connection pool metrics"""
+        self.client.get(BASE_URL)
+        response = self.client.get("/health/pool")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertGreater(data["checkouts"], 0)
+        self.assertEqual(data["size"], app.config["DB_POOL_SIZE"])
+        self.assertIn("checkout_wait_seconds", data)
+
+    def test_metrics(self):
+        """It should expose request and query metrics to Prometheus"""
+        self._create_products(1)
+        self.client.get(BASE_URL)
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        body = response.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="GET",resource="ProductCollection",status="200"}', body)
+        self.assertIn('http_request_duration_seconds_bucket{le="0.005",method="POST",'
+                      'resource="ProductCollection",status="201"}', body)
+        self.assertIn('http_requests_in_flight{method="GET",resource="prometheus_metrics"} 1.0', body)
+        self.assertIn('db_query_duration_seconds_count{operation="INSERT"}', body)
+        # the connection pool of the worker, as in /health/pool
+        self.assertIn("db_pool_checkouts_total ", body)
+        self.assertIn("db_pool_checkout_wait_seconds_count ", body)
+        self.assertIn('db_pool_connections{state="idle"}', body)
+
     def test_get_products(self):
         """It should Get a list of Products"""
         self._create_products(5)
@@ -96,6 +172,149 @@ class TestProductServer(TestCase):
         data = response.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_get_products_paginated(self):
+        """It should page through the list of Products with a cursor"""
+        products = self._create_products(5)
+        response = self.client.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        seen = [product["id"] for product in response.get_json()]
+        self.assertEqual(len(seen), 2)
+        self.assertIn('rel="next"', response.headers["Link"])
+        while "X-Next-Cursor" in response.headers:
+            response = self.client.get(BASE_URL, query_string={
+                "limit": 2, "cursor": response.headers["X-Next-Cursor"]})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen += [product["id"] for product in response.get_json()]
+        self.assertNotIn("Link", response.headers)
+        self.assertEqual(sorted(seen), sorted(product.id for product in products))
+
+    def test_get_products_paginated_with_filter(self):
+        """It should keep the filters when paging through Products"""
+        products = self._create_products(10)
+        test_name = products[0].name
+        count = len([product for product in products if product.name == test_name])
+        response = self.client.get(
+            BASE_URL, query_string={"name": test_name, "limit": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 1)
+        if count > 1:
+            self.assertIn(f"name={quote_plus(test_name)}", response.headers["Link"])
+
+    def test_get_products_ndjson_stream(self):
+        """It should stream the list of Products as NDJSON"""
+        products = self._create_products(5)
+        response = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 5)
+        data = [json.loads(line) for line in lines]
+        self.assertEqual(sorted(product["id"] for product in data),
+                         sorted(product.id for product in products))
+
+    def test_get_products_json_stream(self):
+        """It should stream the list of Products as a chunked JSON array"""
+        self._create_products(3)
+        response = self.client.get(BASE_URL, query_string="stream=true")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(len(response.get_json()), 3)
+        response = self.client.get(BASE_URL, query_string="stream=true&limit=2")
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertIn("X-Next-Cursor", response.headers)
+
+    def test_get_products_sparse_fields(self):
+        """It should List only the requested fields of Products"""
+        products = self._create_products(5)
+        response = self.client.get(BASE_URL, query_string="fields=id,price")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 5)
+        for product in data:
+            self.assertEqual(list(product), ["id", "price"])
+            self.assertIsInstance(product["id"], str)
+        prices = {product.id: product.price for product in products}
+        self.assertEqual({product["id"]: product["price"] for product in data}, prices)
+
+    def test_get_products_sparse_fields_paginated(self):
+        """It should page through sorted Products without returning the sort key"""
+        products = self._create_products(5)
+        response = self.client.get(BASE_URL, query_string="fields=name&sort=price&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        seen = response.get_json()
+        while "X-Next-Cursor" in response.headers:
+            response = self.client.get(BASE_URL, query_string={
+                "fields": "name", "sort": "price", "limit": 2,
+                "cursor": response.headers["X-Next-Cursor"]})
+            seen += response.get_json()
+        self.assertEqual(len(seen), 5)
+        for product in seen:
+            self.assertEqual(list(product), ["name"])
+        self.assertEqual(sorted(product["name"] for product in seen),
+                         sorted(product.name for product in products))
+        response = self.client.get(BASE_URL, query_string="fields=like_num,id&stream=true&limit=2")
+        self.assertEqual([list(product) for product in response.get_json()],
+                         [["like_num", "id"], ["like_num", "id"]])
+
+    def test_get_products_bad_fields(self):
+        """It should not List Products with unknown fields"""
+        response = self.client.get(BASE_URL, query_string="fields=id,secret")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_products_by_ids(self):
+        """It should Get many Products by id, in order, in one query"""
+        products = self._create_products(3)
+        ids = [products[2].id, "0", products[0].id, products[2].id]
+        response = self.client.get(BASE_URL, query_string={"ids": ",".join(ids)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data], [products[2].id, products[0].id])
+        self.assertEqual(data[1]["name"], products[0].name)
+        self.assertEqual(response.headers["X-Missing-Ids"], "0")
+        self.assertEqual(response.headers["X-DB-Queries"], "1")
+
+        response = self.client.get(BASE_URL, query_string={"ids": products[1].id, "fields": "price"})
+        self.assertEqual(response.get_json(), [{"price": products[1].price}])
+        self.assertNotIn("X-Missing-Ids", response.headers)
+        response = self.client.get(BASE_URL, query_string="ids=1,two")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="ids=1,-2147483649")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_products(self):
+        """It should look up many posted Product ids"""
+        products = self._create_products(2)
+        ids = [int(products[1].id), 0, int(products[0].id)]
+        response = self.client.post(f"{BASE_URL}:lookup", json={"ids": ids})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data["products"]],
+                         [products[1].id, products[0].id])
+        self.assertEqual(data["missing"], ["0"])
+        self.assertNotIn("ETag", response.headers)
+
+        response = self.client.post(f"{BASE_URL}:lookup?fields=id,like_num", json={"ids": ids[:1]})
+        self.assertEqual(response.get_json()["products"],
+                         [{"id": products[1].id, "like_num": products[1].like_num}])
+
+    def test_lookup_products_bad_data(self):
+        """It should not look up ids that are missing, invalid or too many"""
+        url = f"{BASE_URL}:lookup"
+        self.assertEqual(self.client.post(url, json={"ids": []}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(url, json=[1, 2]).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(url, json={"ids": [1, None]}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(url, json={"ids": [1, 2 ** 31]}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(url, data="1,2", content_type="text/plain").status_code,
+                         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        ids = list(range(app.config["LOOKUP_IDS_MAX"] + 1))
+        self.assertEqual(self.client.post(url, json={"ids": ids}).status_code,
+                         status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
     def test_get_product_list_by_name(self):
         """It should Query Product by Name"""
         products = self._create_products(10)
@@ -152,6 +371,61 @@ class TestProductServer(TestCase):
         self.assertEqual(data[0]["description"], test_product['description'])
         self.assertEqual(data[0]["price"], test_product['price'])
 
+    def test_get_products_with_filters(self):
+        """It should Query Products by several filters with a sort order"""
+        Product(name="shoes", description="running shoes", price=80, like_num=5).create()
+        Product(name="shoes", description="dress shoes", price=120, like_num=9).create()
+        Product(name="shoes", description="old shoes", price=40, like_num=1,
+                is_on_shelf=False).create()
+        Product(name="hats", description="summer", price=20, like_num=7).create()
+        resp = self.client.get(BASE_URL, query_string={
+            "name": "shoes", "is_on_shelf": "true", "sort": "price", "order": "desc"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([product["price"] for product in resp.get_json()], [120, 80])
+        resp = self.client.get(BASE_URL, query_string={
+            "price_min": 30, "price": 100, "like_min": 2})
+        self.assertEqual([product["price"] for product in resp.get_json()], [80])
+        resp = self.client.get(BASE_URL, query_string={"sort": "like_num", "limit": 2})
+        self.assertEqual([product["like_num"] for product in resp.get_json()], [1, 5])
+        resp = self.client.get(BASE_URL, query_string={
+            "sort": "like_num", "limit": 2, "cursor": resp.headers["X-Next-Cursor"]})
+        self.assertEqual([product["like_num"] for product in resp.get_json()], [7, 9])
+        resp = self.client.get(BASE_URL, query_string="sort=description")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_products(self):
+        """It should Search Products by name and description"""
+        Product(name="shoes", description="running shoes", price=80).create()
+        Product(name="socks", description="for shoes", price=5).create()
+        Product(name="hats", description="summer", price=20).create()
+        resp = self.client.get(BASE_URL, query_string="q=shoes")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([product["name"] for product in data], ["shoes", "socks"])
+
+    def test_search_products_paginated(self):
+        """It should page through the matches of a search most relevant first"""
+        for name, description in [("socks", "for shoes"), ("shoes", "running shoes"), ("boots", "shoes"),
+                                  ("shoes", "dress shoes"), ("hats", "summer"), ("belts", "shoes")]:
+            Product(name=name, description=description, price=10).create()
+        expected = [product["id"] for product in self.client.get(BASE_URL, query_string="q=shoes").get_json()]
+        self.assertEqual(len(expected), 5)
+        seen, cursor = [], None
+        while True:
+            query = {"q": "shoes", "limit": 2}
+            if cursor:
+                query["cursor"] = cursor
+            resp = self.client.get(BASE_URL, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen += [product["id"] for product in resp.get_json()]
+            self.assertNotIn("rank", resp.get_json()[0])
+            cursor = resp.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        self.assertEqual(seen, expected)
+        resp = self.client.get(BASE_URL, query_string={"q": "shoes", "limit": 2, "stream": "true"})
+        self.assertEqual([product["id"] for product in resp.get_json()], expected[:2])
+
     def test_create_product(self):
         """It should Create a new Product"""
         test_product = ProductFactory()
@@ -177,6 +451,124 @@ class TestProductServer(TestCase):
         self.assertEqual(new_product["description"], test_product.description)
         self.assertEqual(new_product["price"], test_product.price)
 
+    def test_create_products_batch(self):
+        """It should Create many Products in one request"""
+        test_products = ProductFactory.build_batch(3)
+        body = [product.serialize() for product in test_products]
+        body.insert(1, {"name": "jewelry"})
+        response = self.client.post(f"{BASE_URL}:batch", json=body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["created"], 3)
+        self.assertEqual(data["failed"], 1)
+        self.assertEqual([result["status"] for result in data["results"]],
+                         [201, 400, 201, 201])
+        self.assertIn("missing price", data["results"][1]["error"])
+        for result, product in zip(data["results"][:1] + data["results"][2:], test_products):
+            response = self.client.get(f"{BASE_URL}/{result['id']}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["name"], product.name)
+
+    def test_create_products_batch_bad_types(self):
+        """It should reject the items whose values do not fit their columns one by one"""
+        good = ProductFactory.build().serialize()
+        body = [good, dict(good, price=1.5), dict(good, like_num="many"), dict(good, is_on_shelf="yes"),
+                dict(good, price=2 ** 31), dict(good, like_num=-2 ** 40), dict(good, price=7.0)]
+        response = self.client.post(f"{BASE_URL}:batch", json=body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([result["status"] for result in data["results"]],
+                         [201, 400, 400, 400, 400, 400, 201])
+        self.assertIn("price must be an integer", data["results"][1]["error"])
+        self.assertIn("like_num must be an integer", data["results"][2]["error"])
+        self.assertIn("is_on_shelf must be a boolean", data["results"][3]["error"])
+        self.assertIn("price is out of range", data["results"][4]["error"])
+        self.assertIn("like_num is out of range", data["results"][5]["error"])
+        response = self.client.get(f"{BASE_URL}/{data['results'][6]['id']}")
+        self.assertEqual(response.get_json()["price"], 7)
+
+    def test_create_products_batch_ndjson(self):
+        """It should Create many Products from an NDJSON body"""
+        lines = [json.dumps(product.serialize()) for product in ProductFactory.build_batch(4)]
+        lines.append("not json")
+        response = self.client.post(f"{BASE_URL}:batch", data="\n".join(lines),
+                                    content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["created"], 4)
+        self.assertEqual(data["failed"], 1)
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 4)
+
+    def test_product_changes(self):
+        """It should sync the changes of the catalog since a cursor"""
+        start = self.client.get(f"{BASE_URL}/changes", query_string="limit=1000").get_json()
+        while start["more"]:
+            start = self.client.get(f"{BASE_URL}/changes", query_string={"since": start["next"]}).get_json()
+        products = self._create_products(2)
+        self.client.put(f"{BASE_URL}/{products[0].id}/like")
+        self.client.delete(f"{BASE_URL}/{products[1].id}")
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": start["next"]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([(change["id"], change["deleted"]) for change in data["changes"]],
+                         [(products[0].id, False), (products[1].id, True)])
+        self.assertEqual(data["changes"][0]["like_num"], products[0].like_num + 1)
+        self.assertIn("updated_at", data["changes"][1])
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": data["next"]})
+        self.assertEqual(response.get_json()["changes"], [])
+
+    def test_product_changes_bad_cursor(self):
+        """It should not list changes after a bad cursor"""
+        response = self.client.get(f"{BASE_URL}/changes", query_string="since=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for cursor in ([2 ** 63, 0], [1, -2 ** 63 - 1], [True, 1], ["1", 1]):
+            response = self.client.get(f"{BASE_URL}/changes", query_string={"since": encode_cursor(cursor)})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_products(self):
+        """It should stream every Product as NDJSON or CSV"""
+        products = self._create_products(3)
+        response = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        data = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(sorted(product["id"] for product in data),
+                         sorted(product.id for product in products))
+        response = self.client.get(f"{BASE_URL}/export", headers={"Accept": "text/csv"})
+        self.assertEqual(response.mimetype, "text/csv")
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 4)
+        self.assertIn("products.csv", response.headers["Content-Disposition"])
+
+    def test_import_products(self):
+        """It should import Products from an NDJSON or CSV upload"""
+        body = '{"name": "lamp", "price": 12}\n{"name": "desk"}\n'
+        response = self.client.post(f"{BASE_URL}/import", data=body,
+                                    content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual((data["imported"], data["failed"]), (1, 1))
+        self.assertEqual(data["errors"][0]["line"], 2)
+
+        body = "name,price,like_num\nchair,30,4\n"
+        response = self.client.post(f"{BASE_URL}/import?mode=replace", data=body,
+                                    content_type="text/csv")
+        self.assertEqual(response.get_json()["imported"], 1)
+        data = self.client.get(BASE_URL).get_json()
+        self.assertEqual([(product["name"], product["like_num"]) for product in data], [("chair", 4)])
+
+    def test_import_products_bad_data(self):
+        """It should not import a bad upload"""
+        response = self.client.post(f"{BASE_URL}/import", json=[{"name": "lamp", "price": 1}])
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        response = self.client.post(f"{BASE_URL}/import?mode=replace", data="not json\n",
+                                    content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/import?mode=merge", data="",
+                                    content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_product(self):
         """It should Update an existing Product"""
         # create a product to update
@@ -206,6 +598,141 @@ class TestProductServer(TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(data["name"], product.name)
 
+    def test_read_product_sparse_fields(self):
+        """It should Get only the requested fields of a Product"""
+        product = ProductFactory()
+        product.create()
+        url = f"{BASE_URL}/{product.id}"
+        resp = self.client.get(url, query_string="fields=price,name")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"price": product.price, "name": product.name})
+        resp = self.client.get(url, query_string="fields=colour")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(f"{BASE_URL}/0", query_string="fields=id")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_read_product_cached(self):
+        """It should serve a Product from the cache until it changes"""
+        test_product = self._create_products(1)[0]
+        url = f"{BASE_URL}/{test_product.id}"
+        before = self.client.get("/health/cache").get_json()
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        response = self.client.get(url)
+        self.assertEqual(response.get_json()["name"], test_product.name)
+        stats = self.client.get("/health/cache").get_json()
+        self.assertEqual(stats["hits"] - before["hits"], 1)
+        self.assertEqual(stats["misses"] - before["misses"], 1)
+
+        # writes must invalidate the cached Product
+        data = response.get_json()
+        data["name"] = "renamed"
+        self.client.put(url, json=data)
+        self.assertEqual(self.client.get(url).get_json()["name"], "renamed")
+        like_num = self.client.put(f"{url}/like").get_json()["like_num"]
+        self.assertEqual(self.client.get(url).get_json()["like_num"], like_num)
+        self.client.put(f"{url}/off-shelf")
+        self.assertFalse(self.client.get(url).get_json()["is_on_shelf"])
+        self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_read_product_query_headers(self):
+        """It should report the SQL queries of each request in the headers"""
+        test_product = self._create_products(1)[0]
+        url = f"{BASE_URL}/{test_product.id}"
+        response = self.client.get(url)
+        self.assertEqual(response.headers["X-DB-Queries"], "1")
+        self.assertRegex(response.headers["Server-Timing"],
+                         r'^db;dur=[0-9.]+;desc="1 queries", total;dur=[0-9.]+$')
+        response = self.client.get(url)
+        self.assertEqual(response.headers["X-DB-Queries"], "0")
+
+    def test_read_product_not_modified(self):
+        """It should return 304 Not Modified for a Product with a matching ETag"""
+        test_product = self._create_products(1)[0]
+        url = f"{BASE_URL}/{test_product.id}"
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response.headers["ETag"], etag)
+
+        # a change must produce a new ETag
+        self.client.put(f"{url}/like")
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_update_product_if_match(self):
+        """It should update a Product only if it has not changed since the ETag in If-Match"""
+        response = self.client.post(BASE_URL, json=ProductFactory().serialize())
+        self.assertEqual(response.headers["ETag"], '"1"')
+        url = response.headers["Location"]
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        self.assertEqual(etag, '"1"')
+        self.assertEqual(self.client.get(f"{url}?fields=id,price").headers["ETag"], '"1-id.price"')
+        first = dict(response.get_json(), name="first editor")
+        second = dict(response.get_json(), name="second editor")
+
+        # both editors read version 1: the first one wins, the second one is told
+        response = self.client.put(url, json=first, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], '"2"')
+        self.assertNotIn("version", response.get_json())
+        response = self.client.put(url, json=second, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.get(url)
+        self.assertEqual(response.get_json()["name"], "first editor")
+        self.assertEqual(response.headers["ETag"], '"2"')
+
+        # the ETag of some fields, several ETags and * match too
+        etag = self.client.get(f"{url}?fields=name").headers["ETag"]
+        response = self.client.put(url, json=second, headers={"If-Match": f'"1", {etag}'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(url, json=first, headers={"If-Match": "*"})
+        self.assertEqual(response.headers["ETag"], '"4"')
+        response = self.client.put(url, json=first, headers={"If-Match": '"garbage"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.put(f"{BASE_URL}/0", json=first, headers={"If-Match": '"1"'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_product_if_match_required(self):
+        """It should reject the updates sent without If-Match when it is required"""
+        product = self._create_products(1)[0]
+        url = f"{BASE_URL}/{product.id}"
+        app.config["PUT_REQUIRE_IF_MATCH"] = True
+        try:
+            response = self.client.put(url, json=product.serialize())
+            self.assertEqual(response.status_code, status.HTTP_428_PRECONDITION_REQUIRED)
+            response = self.client.put(url, json=product.serialize(), headers={"If-Match": '"1"'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        finally:
+            app.config["PUT_REQUIRE_IF_MATCH"] = False
+
+    def test_get_products_not_modified(self):
+        """It should return 304 Not Modified for a list with a matching ETag"""
+        products = self._create_products(3)
+        response = self.client.get(BASE_URL)
+        etag = response.headers["ETag"]
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.client.put(f"{BASE_URL}/{products[0].id}/like")
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 3)
+
+        # revalidated from the change indexes alone, before the rows are read
+        etag = response.headers["ETag"]
+        response = self.client.get(BASE_URL, query_string="sort=price&limit=2",
+                                   headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers["X-DB-Queries"], "1")
+        self.client.delete(f"{BASE_URL}/{products[2].id}")
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+
     def test_delete_product(self):
         """It should Delete an existing Product"""
         test_product = self._create_products(1)[0]
@@ -229,6 +756,7 @@ class TestProductServer(TestCase):
         response = self.client.put(f"{BASE_URL}/{product_id}/like")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.get_json()["like_num"], 1)
+        self.assertEqual(response.get_json()["id"], product_id)
         response = self.client.put(f"{BASE_URL}/{product_id}/like")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.get_json()["like_num"], 2)
@@ -244,6 +772,54 @@ class TestProductServer(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.get_json()["like_num"], -1)
 
+    def test_like_action_concurrently(self):
+        """It should not lose likes made concurrently"""
+        product_id = self._create_products(1)[0].id
+        likers, likes_each = 8, 10
+        # assertions fail silently in threads: check the statuses afterwards
+        statuses = []
+
+        def like():
+            client = app.test_client()
+            for _ in range(likes_each):
+                statuses.append(client.put(f"{BASE_URL}/{product_id}/like").status_code)
+
+        response = self.client.get(f"{BASE_URL}/{product_id}")
+        start = response.get_json()["like_num"]
+        threads = [threading.Thread(target=like) for _ in range(likers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(statuses, [status.HTTP_200_OK] * likers * likes_each)
+        response = self.client.get(f"{BASE_URL}/{product_id}")
+        self.assertEqual(response.get_json()["like_num"], start + likers * likes_each)
+
+    def test_like_action_buffered(self):
+        """It should buffer likes and write them in one batch"""
+        product_id = self._create_products(1)[0].id
+        start = Product.find(product_id).like_num
+        flush_interval = like_buffer.flush_interval
+        like_buffer.enabled = True
+        like_buffer.flush_interval = 60
+        try:
+            for count in range(1, 4):
+                response = self.client.put(f"{BASE_URL}/{product_id}/like")
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.get_json()["like_num"], start + count)
+                # the Product is read through the cache, not queried on every like
+                self.assertEqual(response.headers["X-DB-Queries"], "0" if count > 1 else "1")
+            response = self.client.put(f"{BASE_URL}/{product_id}/unlike")
+            self.assertEqual(response.get_json()["like_num"], start + 2)
+            response = self.client.put(f"{BASE_URL}/4567486/like")
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            like_buffer.flush()
+        finally:
+            like_buffer.enabled = False
+            like_buffer.flush_interval = flush_interval
+        db.session.expire_all()
+        self.assertEqual(Product.find(product_id).like_num, start + 2)
+
     def test_on_shelf_action(self):
         """It should change the is_on_shelf of an existing Product"""
         # create a product to update
@@ -274,6 +850,20 @@ class TestProductServer(TestCase):
 
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_products_bad_cursor(self):
+        """It should not List Products with a bad cursor"""
+        response = self.client.get(BASE_URL, query_string="cursor=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string={"sort": "price", "cursor": encode_cursor(["1", 2])})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_read_product_bad_id(self):
+        """It should not Get a Product with an id that is not a number"""
+        resp = self.client.get(f"{BASE_URL}/abc")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_create_product_no_data(self):
         """It should not Create a Product with missing data"""
         response = self.client.post(BASE_URL, json={})
@@ -294,6 +884,16 @@ class TestProductServer(TestCase):
         response = self.client.post(BASE_URL, json=test_product.serialize())
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_create_products_batch_bad_data(self):
+        """It should not Create a batch that is not a list of Products"""
+        response = self.client.post(f"{BASE_URL}:batch", json={"name": "shoes"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}:batch", json=[])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}:batch", data="name,price",
+                                    content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_update_product_no_content_type(self):
         """It should not update a product with no content type"""
         # create a product to update
@@ -360,3 +960,143 @@ class TestProductServer(TestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         response = self.client.put(f"{BASE_URL}/{test_product.id}/off-shelf")
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stream_product_changes(self):
+        """It should push the changes of the followed Products as Server-Sent Events"""
+        followed, other = self._create_products(2)
+        response = self.client.get(f"{BASE_URL}/stream?ids={followed.id}", buffered=False)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        events = iter(response.response)
+        self.assertEqual(next(events), b"retry: 3000\n\n")
+        self.client.put(f"{BASE_URL}/{other.id}/like")
+        self.client.put(f"{BASE_URL}/{followed.id}/like")
+        self.client.delete(f"{BASE_URL}/{followed.id}")
+        event = next(events).decode("utf-8")
+        self.assertTrue(event.startswith("event: product\ndata: "))
+        data = json.loads(event.split("data: ", 1)[1])
+        self.assertEqual(data["id"], followed.id)
+        self.assertEqual(data["like_num"], (followed.like_num or 0) + 1)
+        self.assertFalse(data["deleted"])
+        data = json.loads(next(events).decode("utf-8").split("data: ", 1)[1])
+        self.assertEqual(data, {"id": followed.id, "deleted": True})
+        response.close()
+
+    def test_stream_bad_ids(self):
+        """It should not stream the changes of invalid ids"""
+        response = self.client.get(f"{BASE_URL}/stream?ids=1,abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_product_stats(self):
+        """It should compute the statistics of the filtered Products in SQL"""
+        for price, on_shelf in ((10, True), (15, True), (19, False), (40, True), (101, False)):
+            ProductFactory(price=price, is_on_shelf=on_shelf).create()
+        response = self.client.get(f"{BASE_URL}/stats?price_max=100&buckets=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {
+            "count": 4,
+            "on_shelf": 3,
+            "on_shelf_ratio": 0.75,
+            "price": {"min": 10, "max": 40, "avg": 21.0},
+            "histogram": [
+                {"min": 10, "max": 20, "count": 3},
+                {"min": 21, "max": 31, "count": 0},
+                {"min": 32, "max": 42, "count": 1},
+            ],
+        })
+        response = self.client.get(f"{BASE_URL}/stats?is_on_shelf=false")
+        data = response.get_json()
+        self.assertEqual((data["count"], data["on_shelf_ratio"]), (2, 0.0))
+        self.assertEqual(sum(bucket["count"] for bucket in data["histogram"]), 2)
+
+    def test_product_stats_empty(self):
+        """It should summarize an empty selection of Products"""
+        response = self.client.get(f"{BASE_URL}/stats?name=nothing")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {
+            "count": 0, "on_shelf": 0, "on_shelf_ratio": None,
+            "price": {"min": None, "max": None, "avg": None}, "histogram": [],
+        })
+
+    def test_product_stats_cached(self):
+        """It should serve the statistics from the cache for a few seconds"""
+        ProductFactory(price=5).create()
+        self.assertEqual(self.client.get(f"{BASE_URL}/stats?name=cached").get_json()["count"], 0)
+        ProductFactory(name="cached", price=5).create()
+        self.assertEqual(self.client.get(f"{BASE_URL}/stats?name=cached").get_json()["count"], 0)
+        Product.stats_cache.clear()
+        self.assertEqual(self.client.get(f"{BASE_URL}/stats?name=cached").get_json()["count"], 1)
+
+    def test_product_stats_bad_buckets(self):
+        """It should not accept an invalid number of buckets"""
+        for buckets in ("0", "1000", "x"):
+            response = self.client.get(f"{BASE_URL}/stats?buckets={buckets}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_top_products(self):
+        """It should list the most liked Products on shelf from memory"""
+        products = [ProductFactory(like_num=likes, is_on_shelf=True) for likes in (3, 8, 5)]
+        for product in products:
+            product.create()
+        response = self.client.get(f"{BASE_URL}/top?by=like_num&n=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([product["id"] for product in response.get_json()],
+                         [str(products[1].id), str(products[2].id)])
+        seeds = leaderboard.seeds
+        for _ in range(4):
+            self.client.put(f"{BASE_URL}/{products[0].id}/like")
+        self.client.put(f"{BASE_URL}/{products[1].id}/off-shelf")
+        data = self.client.get(f"{BASE_URL}/top?n=2").get_json()
+        self.assertEqual([(product["id"], product["like_num"]) for product in data],
+                         [(str(products[0].id), 7), (str(products[2].id), 5)])
+        self.assertEqual(leaderboard.seeds, seeds)
+
+    def test_top_products_bad_args(self):
+        """It should only rank by like_num and up to TOP_MAX_N Products"""
+        for query in ("by=price", "n=0", f"n={app.config['TOP_MAX_N'] + 1}"):
+            response = self.client.get(f"{BASE_URL}/top?{query}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_coalesce_concurrent_reads(self):
+        """It should serve concurrent reads of a Product with one query"""
+        product = self._create_products(1)[0]
+        Product.cache.clear()
+        db.session.remove()
+        before = Product.flights.stats()
+        release, started = threading.Event(), threading.Event()
+        read = Product.read
+
+        def slow_read(*args):
+            started.set()
+            release.wait(5)
+            return read(*args)
+        responses = []
+
+        def get():
+            responses.append(app.test_client().get(f"{BASE_URL}/{product.id}").status_code)
+        threads = [threading.Thread(target=get) for _ in range(5)]
+        with patch.object(Product, "read", side_effect=slow_read):
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            # the followers only count once they joined the flight
+            while Product.flights.stats()["shared"] - before["shared"] < 4:
+                threading.Event().wait(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+        after = Product.flights.stats()
+        self.assertEqual(responses, [status.HTTP_200_OK] * 5)
+        self.assertEqual(after["executed"] - before["executed"], 1)
+        self.assertEqual(after["shared"] - before["shared"], 4)
+        response = self.client.get("/health/single-flight")
+        self.assertEqual(response.get_json()["product"], after)
+
+    def test_writes_forget_listings_in_flight(self):
+        """It should not let a listing read after a write join a read started before it"""
+        product = self._create_products(1)[0]
+        list_flights._flights[("in", "flight")] = "started before the write"  # pylint: disable=protected-access
+        self.client.put(f"{BASE_URL}/{product.id}/like")
+        self.assertEqual(list_flights._flights, {})  # pylint: disable=protected-access
+
@@ -0,0 +1,63 @@
+"""
+Serializers Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+import datetime
+import json
+from unittest import TestCase
+from flask_restx import marshal
+from service import app
+from service.common import serializers
+from service.routes import product_model
+from tests.factories import ProductFactory
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializers(TestCase):
+    """Test Cases for the fast Product serializers"""
+
+    def test_rows_match_marshalling(self):
+        """It should shape rows exactly like marshalling with product_model"""
+        products = ProductFactory.build_batch(5)
+        products[0].description = None
+        rows = [tuple(product.serialize()[field] for field in serializers.PRODUCT_FIELDS)
+                for product in products]
+        with app.app_context():
+            expected = marshal([product.serialize() for product in products], product_model)
+        self.assertEqual(serializers.rows_to_products(rows), json.loads(json.dumps(expected)))
+
+    def test_shape_product(self):
+        """It should shape a serialized Product like product_model"""
+        data = ProductFactory().serialize()
+        shaped = serializers.shape_product(data)
+        self.assertEqual(shaped["id"], str(data["id"]))
+        self.assertIsInstance(data["id"], int)
+
+    def test_rows_without_id(self):
+        """It should shape rows of other fields"""
+        rows = [(1, True), (2, False)]
+        self.assertEqual(serializers.rows_to_products(rows, ("price", "is_on_shelf")),
+                         [{"price": 1, "is_on_shelf": True}, {"price": 2, "is_on_shelf": False}])
+
+    def test_rows_with_extra_columns(self):
+        """It should drop the columns selected only for pagination"""
+        rows = [(10, 1, "a"), (20, 2, "b")]
+        self.assertEqual(serializers.rows_to_products(rows, ("price", "id", "name"), ("name",)),
+                         [{"name": "a"}, {"name": "b"}])
+
+    def test_parse_fields(self):
+        """It should parse a list of Product fields"""
+        self.assertEqual(serializers.parse_fields("id, price,id"), ("id", "price"))
+        self.assertRaises(ValueError, serializers.parse_fields, "id,secret")
+        self.assertRaises(ValueError, serializers.parse_fields, "")
+
+    def test_dumps(self):
+        """It should encode JSON, including dates"""
+        when = datetime.datetime(2022, 11, 1, 12, 30)
+        data = json.loads(serializers.dumps({"id": "1", "at": when, "tags": [1, None]}))
+        self.assertEqual(data, {"id": "1", "at": "2022-11-01T12:30:00", "tags": [1, None]})
+        self.assertRaises(TypeError, serializers.dumps, {"bad": object()})
@@ -0,0 +1,91 @@
+"""
+Single Flight Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+import threading
+from unittest import TestCase
+from service.common.single_flight import SingleFlight, stats
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """Test Cases for the coalescing of concurrent identical reads"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.flights = SingleFlight("test")
+        self.release = threading.Event()
+        self.calls = []
+
+    def read(self, value):
+        """A read that waits for the test to release it"""
+        self.calls.append(value)
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return {"value": value}
+
+    def run_concurrently(self, count, key, value):
+        """Calls the read from count threads and returns their results once released"""
+        results = [None] * count
+
+        def call(index):
+            try:
+                results[index] = self.flights.do(key, self.read, value)
+            except Exception as error:  # pylint: disable=broad-except
+                results[index] = error
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+        threads[0].start()
+        while not self.calls:
+            threading.Event().wait(0.001)  # the first thread leads
+        for thread in threads[1:]:
+            thread.start()
+        threading.Event().wait(0.1)  # let the followers join the flight
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce(self):
+        """It should run one read for concurrent callers of the same key"""
+        results = self.run_concurrently(8, "a", 1)
+        self.assertEqual(self.calls, [1])
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(self.flights.stats(), {"executed": 1, "shared": 7, "ratio": 7 / 8})
+        self.assertEqual(stats()["test"], self.flights.stats())
+
+    def test_share_errors(self):
+        """It should raise the error of the read in every caller"""
+        error = ValueError("database is down")
+        results = self.run_concurrently(3, "a", error)
+        self.assertEqual(results, [error] * 3)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_sequential_calls(self):
+        """It should not keep results once the read returned"""
+        self.release.set()
+        self.flights.do("a", self.read, 1)
+        self.flights.do("a", self.read, 2)
+        self.flights.do("b", self.read, 3)
+        self.assertEqual(self.calls, [1, 2, 3])
+        self.assertEqual(self.flights.stats()["shared"], 0)
+
+    def test_forget(self):
+        """It should start a new read after a key was forgotten"""
+        self.release.set()
+        self.flights._flights["a"] = "in flight"  # pylint: disable=protected-access
+        self.flights.forget("a")
+        self.assertEqual(self.flights.do("a", self.read, 1), {"value": 1})
+
+    def test_forget_all(self):
+        """It should forget every key, or the keys a match selects"""
+        flights = self.flights._flights  # pylint: disable=protected-access
+        flights.update({(1, "a"): 1, (1, "b"): 2, (2, "a"): 3})
+        self.flights.forget_all(lambda key: key[0] == 1)
+        self.assertEqual(list(flights), [(2, "a")])
+        self.flights.forget_all()
+        self.assertEqual(flights, {})